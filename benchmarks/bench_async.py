@@ -0,0 +1,66 @@
+"""
+Compare dogbutler.async.get on the shared worker pool with the old
+thread-per-request implementation.
+
+Each mode runs in its own process so the reported peak RSS is not shared.
+The origin is simulated with a fixed latency, so no network is needed:
+
+    python benchmarks/bench_async.py [n_requests] [latency_seconds]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+from Queue import Queue
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mock import patch
+from requests.models import Response
+
+from dogbutler import api, async
+
+
+def thread_per_request_get(requests):
+    """
+    The implementation async.get replaced: one Thread and one Queue per request.
+    """
+    queues = []
+    for url, kwargs in requests:
+        q = Queue()
+        queues.append(q)
+        call_kwargs = dict(kwargs)
+        call_kwargs.update({'url': url, 'queue': q})
+        Thread(target=api.get, kwargs=call_kwargs).start()
+    return [q.get(timeout=async.DEFAULT_TIMEOUT) for q in queues]
+
+
+def run(mode, n, latency):
+    def fake_get(url, *args, **kwargs):
+        time.sleep(latency)
+        response = Response()
+        response.status_code = 200
+        response._content = 'x' * 1024
+        response.headers = {}
+        return response
+
+    requests = [('http://www.test.com/path/%d' % i, {}) for i in range(n)]
+    get = async.get if mode == 'pool' else thread_per_request_get
+    with patch('requests.Session.get', side_effect=fake_get):
+        start = time.time()
+        get(requests)
+        elapsed = time.time() - start
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%-8s %6d requests  %8.1f req/s  peak RSS %8d KB' % (mode, n, n / elapsed, max_rss)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('pool', 'threads'):
+        run(sys.argv[1], int(sys.argv[2]), float(sys.argv[3]))
+    else:
+        n = sys.argv[1] if len(sys.argv) > 1 else '2000'
+        latency = sys.argv[2] if len(sys.argv) > 2 else '0.01'
+        for mode in ('threads', 'pool'):
+            subprocess.check_call([sys.executable, __file__, mode, n, latency])
@@ -0,0 +1,96 @@
+"""
+Count cache backend round trips and time per request for the main paths
+through CacheManager: a cold miss, a fresh hit and a 304 revalidation.
+
+    python benchmarks/bench_cache.py [n_requests]
+"""
+from datetime import datetime, timedelta
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dummycache import cache as dummycache_cache
+from dummycache.cache import Cache
+from mock import patch
+from requests.models import Response
+
+from dogbutler import cache as dogbutler_cache
+from dogbutler.client import Client
+
+
+class Clock(object):
+    """
+    Stands in for datetime in dummycache and dogbutler.cache so entries can be
+    made stale on demand.
+    """
+    offset = timedelta(0)
+
+    def now(self):
+        return datetime.now() + self.offset
+
+    def __getattr__(self, attr):
+        return getattr(datetime, attr)
+
+
+class CountingCache(Cache):
+
+    def __init__(self):
+        super(CountingCache, self).__init__()
+        self.gets = 0
+        self.sets = 0
+
+    def get(self, key, default=None):
+        self.gets += 1
+        return super(CountingCache, self).get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.sets += 1
+        return super(CountingCache, self).set(key, value, timeout)
+
+
+def make_response(status_code):
+    response = Response()
+    response.status_code = status_code
+    response._content = 'x' * 1024 * 64 if status_code == 200 else ''
+    response.headers = {
+        'Cache-Control': 'max-age=60',
+        'ETag': '"fdcd6016cf6059cbbf418d66a51a6b0a"',
+        'Last-Modified': 'Mon, 01 Oct 2012 00:00:00 GMT',
+    }
+    return response
+
+
+def run(name, n, prepare, status_code):
+    cache = CountingCache()
+    client = Client(cache=cache)
+    urls = ['http://www.test.com/path/%d' % i for i in range(n)]
+    with patch('requests.Session.get', side_effect=lambda url, **kwargs: make_response(200)):
+        prepare(client, urls)
+    cache.gets = cache.sets = 0
+    with patch('requests.Session.get', side_effect=lambda url, **kwargs: make_response(status_code)):
+        start = time.time()
+        for url in urls:
+            client.get(url)
+        elapsed = time.time() - start
+    print '%-14s %6.2f gets/req  %6.2f sets/req  %8.1f us/req' % (
+        name, float(cache.gets) / n, float(cache.sets) / n, elapsed / n * 1e6)
+
+
+def warm(client, urls):
+    for url in urls:
+        client.get(url)
+
+
+def warm_and_expire(client, urls):
+    warm(client, urls)
+    clock.offset += timedelta(seconds=61)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    clock = dummycache_cache.datetime = dogbutler_cache.datetime = Clock()
+    run('cold miss', n, lambda client, urls: None, 200)
+    run('fresh hit', n, warm, 200)
+    run('revalidation', n, warm_and_expire, 304)
@@ -0,0 +1,39 @@
+"""
+Compare the size and pickling cost of a cookie stored as a Cookie.Morsel, as
+it used to be, with the plain tuple CookieManager stores now.
+
+    python benchmarks/bench_cookie_record.py [iterations]
+"""
+from Cookie import SimpleCookie
+import cPickle as pickle
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dogbutler.cookie import dump_cookie, load_cookie, parse_set_cookie
+
+
+HEADER = 'session-id=123-4567890-1234567; Domain=.amazon.com; Path=/; Max-Age=31449600; Secure; HttpOnly'
+
+
+def run(name, value, load, iterations):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    start = time.time()
+    for _ in xrange(iterations):
+        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    dumps = time.time() - start
+    start = time.time()
+    for _ in xrange(iterations):
+        load(pickle.loads(data))
+    loads = time.time() - start
+    print '%-8s %4d bytes  %6.2f us/dumps  %6.2f us/loads' % (
+        name, len(data), dumps / iterations * 1e6, loads / iterations * 1e6)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    morsel = SimpleCookie(HEADER)['session-id']
+    run('Morsel', morsel, lambda value: value, iterations)
+    run('tuple', dump_cookie(parse_set_cookie(HEADER)[0]), load_cookie, iterations)
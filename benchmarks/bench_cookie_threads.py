@@ -0,0 +1,68 @@
+"""
+Measure Set-Cookie throughput as the number of threads grows, against a cache
+that takes a millisecond per call like a networked one would. Each thread sets
+cookies for its own domain, so with striped locks they should rarely wait on
+each other. Lost updates are counted at the end of each run.
+
+    python benchmarks/bench_cookie_threads.py [responses per thread]
+"""
+import os
+import sys
+from threading import Thread
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dummycache.cache import Cache
+from requests.models import Response
+
+from dogbutler.cookie import CookieManager
+import dogbutler.models     # Adds Response.has_header
+
+
+LATENCY = 0.001
+
+
+class SlowCache(Cache):
+
+    def get(self, key, default=None):
+        time.sleep(LATENCY)
+        return super(SlowCache, self).get(key, default)
+
+    def set(self, key, value, timeout=None):
+        time.sleep(LATENCY)
+        return super(SlowCache, self).set(key, value, timeout)
+
+
+def run(threads, responses, shared_domain):
+    cookie_manager = CookieManager(key_prefix='bench', cache=SlowCache())
+
+    def work(t):
+        domain = 'shared.test.com' if shared_domain else 'www%d.test.com' % t
+        for i in xrange(responses):
+            response = Response()
+            response.headers = {'Set-Cookie': 'c%d_%d=v; Domain=%s;' % (t, i, domain)}
+            response.url = 'http://%s/' % domain
+            cookie_manager.process_response(None, response)
+
+    workers = [Thread(target=work, args=(t,)) for t in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+
+    if shared_domain:
+        found = len(cookie_manager.get_cookies('http://shared.test.com/'))
+    else:
+        found = sum(len(cookie_manager.get_cookies('http://www%d.test.com/' % t)) for t in range(threads))
+    print '%-7s %3d threads %8.0f responses/s  %d lost' % (
+        'shared' if shared_domain else 'own', threads, threads * responses / elapsed, threads * responses - found)
+
+
+if __name__ == '__main__':
+    responses = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    for shared_domain in (False, True):
+        for threads in (1, 2, 4, 8, 16):
+            run(threads, responses, shared_domain)
@@ -0,0 +1,64 @@
+"""
+Compare parse_set_cookie with the SimpleCookie + regex path it replaced, on a
+corpus of Set-Cookie headers shaped like the ones common sites send.
+
+    python benchmarks/bench_set_cookie.py [iterations]
+"""
+from Cookie import SimpleCookie, CookieError
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dogbutler.cookie import parse_set_cookie
+
+
+CORPUS = [
+    'PREF=ID=1111111111111111:FF=0:TM=1351234567:LM=1351234567:S=AbCdEfGhIjKlMnOp; expires=Sun, 26-Oct-2014 07:36:07 GMT; path=/; domain=.google.com',
+    'NID=65=abcdefghijklmnopqrstuvwxyz0123456789; expires=Sat, 27-Apr-2013 07:36:07 GMT; path=/; domain=.google.com; HttpOnly',
+    'datr=AbCdEfGhIjKlMnOpQrStUvWx; expires=Sat, 25-Oct-2014 07:36:07 GMT; path=/; domain=.facebook.com; httponly',
+    'reg_fb_gate=deleted; expires=Thu, 01-Jan-1970 00:00:01 GMT; path=/; domain=.facebook.com; httponly, '
+    'reg_fb_ref=deleted; expires=Thu, 01-Jan-1970 00:00:01 GMT; path=/; domain=.facebook.com; httponly',
+    'JSESSIONID=0123456789ABCDEF0123456789ABCDEF; Path=/app; Secure; HttpOnly',
+    'session-id=123-4567890-1234567; path=/; domain=.amazon.com; expires=Tue, 01 Jan 2036 08:00:01 GMT',
+    'guest_id=v1%3A135123456789012345; Domain=.twitter.com; Path=/; Expires=Mon, 27-Oct-2014 07:36:07 UTC',
+    '_ga=GA1.2.1234567890.1351234567; Max-Age=63072000; Path=/; Domain=example.com',
+    'locale=en_US; Max-Age=604800; Path=/, csrftoken=abcdef0123456789abcdef0123456789; Max-Age=31449600; Path=/',
+    'BX=abcdefghijklm&b=3&s=ab; expires=Tue, 02-Jun-2037 20:00:00 GMT; path=/; domain=.yahoo.com',
+    'cart="item1,item2"; Path=/shop; Expires=Wed, 09 Jun 2021 10:18:14 GMT',
+    'flash=; Max-Age=0; Path=/',
+]
+
+
+def simplecookie_parse(header):
+    """
+    The parsing path parse_set_cookie replaced.
+    """
+    def _add_dash(match_obj):
+        return match_obj.group(0).replace(' ', '-')
+
+    cookie = SimpleCookie()
+    try:
+        cookie.load(re.sub(r'\d{2}\s\w+\s\d{4}', _add_dash, header))
+    except CookieError:
+        pass
+    return cookie
+
+
+def run(name, parse, iterations):
+    parsed = sum(len(parse(header)) for header in CORPUS)
+    start = time.time()
+    for _ in xrange(iterations):
+        for header in CORPUS:
+            parse(header)
+    elapsed = time.time() - start
+    print '%-14s %8.2f us/header  %3d cookies parsed from %d headers' % (
+        name, elapsed / (iterations * len(CORPUS)) * 1e6, parsed, len(CORPUS))
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    run('SimpleCookie', simplecookie_parse, iterations)
+    run('parse_set_cookie', parse_set_cookie, iterations)
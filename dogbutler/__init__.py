@@ -22,3 +22,7 @@ __license__ = 'ISC'
 __copyright__ = 'Copyright 2012 Vichaya/Euam Sirisanthana'
 
 
+
+
+from dogbutler.api import get
+from dogbutler.client import Client
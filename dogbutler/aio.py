@@ -0,0 +1,74 @@
+"""
+Non-blocking front end for callback and event-driven code.
+
+get() and gather_get() return Futures straight away. They run the same
+redirect, cookie and cache pipeline as dogbutler.get. The request side runs in
+the calling thread, so a cache hit comes back as an already resolved Future
+and never goes near a worker. Only requests that need the network are handed
+to the worker pool, whose threads share the client's keep-alive connections.
+Concurrent misses for the same request share a single fetch.
+"""
+import sys
+from threading import Lock
+
+from dogbutler.defaults import get_default_client, get_default_pool
+from dogbutler.pool import Future
+
+
+def get(url, client=None, pool=None, **kwargs):
+    """
+    Return a Future for the response to a GET request to url.
+    """
+    client = client or get_default_client()
+    pool = pool or get_default_pool()
+
+    try:
+        request, response = client.process_request(url, **kwargs)
+    except Exception:
+        future = Future()
+        future.set_exception(sys.exc_info())
+        return future
+
+    if response is not None:
+        future = Future()
+        future.set_result(response)
+        return future
+
+    return pool.submit(client.fetch, request, **kwargs)
+
+
+def gather_get(requests, client=None, pool=None):
+    """
+    Each request in requests is a tuple of (url, kwargs).
+
+    Return a Future for the list of responses, in the same order as requests.
+    It fails with the first exception raised by any of the requests.
+    """
+    futures = [get(url, client=client, pool=pool, **kwargs) for url, kwargs in requests]
+    return gather(futures)
+
+
+def gather(futures):
+    """
+    Return a Future for the list of results of futures.
+    """
+    gathered = Future()
+    lock = Lock()
+    remaining = [len(futures)]
+
+    def on_done(future):
+        with lock:
+            if gathered.done():
+                return
+            if future._exc_info is not None:
+                gathered.set_exception(future._exc_info)
+                return
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                gathered.set_result([f.result() for f in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(on_done)
+    return gathered
@@ -1,30 +1,79 @@
 from Queue import Queue
-from threading import Thread
+from threading import BoundedSemaphore
 
 from dogbutler import api
+from dogbutler.defaults import get_default_client, get_default_pool
+from dogbutler.pool import Future
 
 
 DEFAULT_TIMEOUT = 60 * 5    # in seconds
 
 
-def get(requests):
+def get(requests, pool=None, max_in_flight=None, client=None):
     """
     Each request in requests is a tuple of (url, kwargs).
+
+    Redirects, cookies and fresh cache hits are resolved for the whole batch
+    first, reading the cache in bulk, and only the requests left over are
+    sent. They run on a shared WorkerPool (the default pool unless one is
+    given), with at most max_in_flight of them (the pool size by default)
+    submitted at a time. Responses are returned in the same order as requests.
+    """
+    client = client or get_default_client()
+    pool = pool or get_default_pool()
+    slots = BoundedSemaphore(max_in_flight or pool.size)
+    release = lambda future: slots.release()
+
+    requests = list(requests)
+    futures = []        # A list of futures to hold return values
+    for (url, kwargs), (request, response) in zip(requests, client.process_requests(requests)):
+        if response is not None:
+            future = Future()
+            future.set_result(response)
+        else:
+            slots.acquire()
+            if request is None:
+                future = pool.submit(client.get, url, **kwargs)
+            else:
+                future = pool.submit(client.fetch, request, **kwargs)
+            future.add_done_callback(release)
+        futures.append(future)
+
+    return [future.result(timeout=DEFAULT_TIMEOUT) for future in futures]
+
+
+def iter_get(requests, pool=None, max_in_flight=None):
     """
-    queues = []         # A list of queues to hold return values
-    threads = []        # A list to hold spawned threads
-    for url, kwargs in requests:
-        q = Queue()
-        queues.append(q)
-
-        call_kwargs = dict(kwargs)
-        call_kwargs.update({
-            'url': url,
-            'queue': q,
-        })
-
-        t = Thread(target=api.get, kwargs=call_kwargs)
-        t.start()
-        threads.append(t)
-
-    return [q.get(timeout=DEFAULT_TIMEOUT) for q in queues]
\ No newline at end of file
+    Each request in requests is a tuple of (url, kwargs); requests may be any
+    iterable, including a generator, and is consumed lazily.
+
+    Yields a tuple of (index, url, response) as each request finishes, where
+    index is the position of the request in requests and response is the
+    exception raised if the request failed. At most max_in_flight requests
+    (the pool size by default) are outstanding at a time.
+    """
+    pool = pool or get_default_pool()
+    max_in_flight = max_in_flight or pool.size
+
+    requests = enumerate(requests)
+    done = Queue()      # A queue of (index, url, future) for finished requests
+    in_flight = 0
+    exhausted = False
+    while True:
+        while not exhausted and in_flight < max_in_flight:
+            try:
+                index, (url, kwargs) = next(requests)
+            except StopIteration:
+                exhausted = True
+                break
+            future = pool.submit(api.get, url, **kwargs)
+            future.add_done_callback(lambda f, index=index, url=url: done.put((index, url, f)))
+            in_flight += 1
+
+        if not in_flight:
+            return
+
+        index, url, future = done.get(timeout=DEFAULT_TIMEOUT)
+        in_flight -= 1
+        exception = future.exception()
+        yield index, url, exception if exception is not None else future.result()
@@ -1,16 +1,217 @@
-from dogbutler.utils.cache import get_cache_key, learn_cache_key, get_max_age
+import copy
+from datetime import datetime, timedelta
+from threading import Lock
 
+from dogbutler.utils.cache import get_cache_key, get_current_age, get_freshness_lifetime, get_many, learn_cache_key, \
+    parse_cache_control, _generate_cache_header_key, _generate_cache_key
+from dogbutler.utils.hashcompat import sha_constructor
 
-CACHE_MANAGER_LONG_TERM_CACHE_KEY_PREFIX = 'longterm'
-CACHE_MANAGER_LONG_TERM_CACHE_SECONDS = 60 * 60 * 24 * 30
+
+CACHE_MANAGER_LONG_TERM_CACHE_SECONDS = 60 * 60 * 24 * 30     # How long a stale entry is kept for revalidation
+CACHE_MANAGER_VALIDATORS_CACHE_KEY_SUFFIX = 'validators'
+CACHE_MANAGER_VALIDATOR_HEADERS = ('ETag', 'Last-Modified', 'Date')
+BODY_STORE_KEY_PREFIX = 'body'
+
+FRESH = 'fresh'         # Can be served without contacting the origin
+STALE = 'stale'         # Must be revalidated with the origin before use
+EXPIRED = 'expired'     # Must not be used at all
+
+
+def get_validators_cache_key(cache_key):
+    return '%s.%s' % (cache_key, CACHE_MANAGER_VALIDATORS_CACHE_KEY_SUFFIX)
+
+def get_validators(response, timeout, age=0):
+    """
+    Returns the small record stored next to a cached response: its validator
+    headers, when it was stored, how old it was then and its freshness
+    lifetime, without the body.
+    """
+    validators = dict((header, response[header]) for header in CACHE_MANAGER_VALIDATOR_HEADERS
+                      if response.has_header(header))
+    validators['max-age'] = timeout
+    validators['age'] = age
+    validators['stored'] = datetime.now()
+    return validators
+
+def get_freshness(validators):
+    """
+    Returns FRESH, STALE or EXPIRED for the entry described by validators.
+    """
+    if validators is None:
+        return EXPIRED
+    age = validators.get('age', 0) + (datetime.now() - validators['stored']).total_seconds()
+    if age < validators['max-age']:
+        return FRESH
+    if age < validators['max-age'] + CACHE_MANAGER_LONG_TERM_CACHE_SECONDS:
+        return STALE
+    return EXPIRED
+
+
+class BodyStore(object):
+    """
+    Stores response bodies by content hash, so identical bodies cached under
+    different keys are kept only once.
+
+    Each body records which cache keys refer to it and until when. It is
+    deleted as soon as the last of them lets go of it, and is otherwise kept
+    only as long as the longest-lived of them.
+    """
+
+    def __init__(self, cache, key_prefix=BODY_STORE_KEY_PREFIX):
+        self.cache = cache
+        self.key_prefix = key_prefix
+        self._lock = Lock()
+
+    def get_body_key(self, body_hash):
+        return '%s.%s' % (self.key_prefix, body_hash)
+
+    def get(self, body_hash):
+        record = self.cache.get(self.get_body_key(body_hash))
+        return record['content'] if record is not None else None
+
+    def add(self, cache_key, content, timeout):
+        """
+        Store content as referred to by cache_key for timeout seconds, and
+        return its hash.
+        """
+        body_hash = sha_constructor(content).hexdigest()
+        with self._lock:
+            record = self.cache.get(self.get_body_key(body_hash)) or {'content': content, 'refs': {}}
+            record['refs'][cache_key] = datetime.now() + timedelta(seconds=timeout)
+            self._save(body_hash, record)
+        return body_hash
+
+    def release(self, cache_key, body_hash):
+        """
+        Drop the reference from cache_key to the body with body_hash.
+        """
+        with self._lock:
+            record = self.cache.get(self.get_body_key(body_hash))
+            if record is not None:
+                record['refs'].pop(cache_key, None)
+                self._save(body_hash, record)
+
+    def _save(self, body_hash, record):
+        now = datetime.now()
+        refs = dict((cache_key, expires) for cache_key, expires in record['refs'].items() if expires > now)
+        if not refs:
+            self.cache.delete(self.get_body_key(body_hash))
+            return
+        record['refs'] = refs
+        timeout = max((expires - now).total_seconds() for expires in refs.values())
+        self.cache.set(self.get_body_key(body_hash), record, timeout)
+
+
+_MISSING = object()
+
+
+class CacheLookup(object):
+    """
+    Cache key and cached entry for one request, each resolved at most once
+    and shared by every stage of the pipeline.
+    """
+
+    def __init__(self, request, key_prefix, cache, body_store=None):
+        self.request = request
+        self.url = request.url
+        self.key_prefix = key_prefix
+        self.cache = cache
+        self.body_store = body_store
+        self._cache_key = _MISSING
+        self._validators = _MISSING
+        self._response = _MISSING
+
+    @property
+    def cache_key(self):
+        if self._cache_key is _MISSING:
+            self._cache_key = get_cache_key(self.request, self.key_prefix, 'GET', cache=self.cache)
+        return self._cache_key
+
+    @property
+    def validators(self):
+        if self._validators is _MISSING:
+            self._validators = self.cache.get(get_validators_cache_key(self.cache_key), None) if self.cache_key is not None else None
+        return self._validators
+
+    @property
+    def freshness(self):
+        return get_freshness(self.validators)
+
+    @property
+    def response(self):
+        if self._response is _MISSING:
+            self.set_response(self.cache.get(self.cache_key, None) if self.freshness != EXPIRED else None)
+        return self._response
+
+    def set_response(self, response):
+        """
+        Set the cached response as read from cache, attaching its body if it
+        is kept in the body store.
+        """
+        if response is not None and 'body' in self.validators:
+            content = self.body_store.get(self.validators['body']) if self.body_store is not None else None
+            if content is None:
+                response = None     # Body has gone, treat the entry as missing
+            else:
+                response = copy.copy(response)
+                response._content = content
+        self._response = response
 
 
 class CacheManager(object):
+    """
+    Caches responses for as long as they are fresh, as defined by RFC 7234:
+    for s-maxage (if shared), max-age or until Expires, or for a fraction of
+    the time since Last-Modified if none of them is given, less whatever Age
+    or Date say the response already was. Responses with no-store or
+    no-cache are never cached, nor private ones if shared. Stale entries are
+    kept for revalidation and never served without it, which is all
+    must-revalidate asks for.
+    """
 
-    def __init__(self, key_prefix, cache, cache_anonymous_only=False):
+    def __init__(self, key_prefix, cache, cache_anonymous_only=False, body_store=None, shared=False):
         self.key_prefix = key_prefix
         self.cache = cache
         self.cache_anonymous_only = cache_anonymous_only
+        self.body_store = body_store
+        self.shared = shared
+
+    def get_lookup(self, request):
+        """
+        Returns the CacheLookup for request, creating it if the request does
+        not have one yet or its URL has changed since (e.g. after a redirect).
+        """
+        lookup = getattr(request, '_cache_lookup', None)
+        if lookup is None or lookup.url != request.url or lookup.cache is not self.cache:
+            lookup = request._cache_lookup = CacheLookup(request, self.key_prefix, self.cache, body_store=self.body_store)
+        return lookup
+
+    def prefetch(self, requests):
+        """
+        Resolve the cache lookups of a batch of requests in bulk: one read
+        for their header lists, one for their validators and one for their
+        fresh responses, instead of up to three reads per request.
+        """
+        lookups = [self.get_lookup(request) for request in requests if request.method in ('GET', 'HEAD')]
+
+        pending = [lookup for lookup in lookups if lookup._cache_key is _MISSING]
+        header_keys = [_generate_cache_header_key(self.key_prefix, lookup.request) for lookup in pending]
+        headerlists = get_many(self.cache, list(set(header_keys))) if header_keys else {}
+        for lookup, header_key in zip(pending, header_keys):
+            headerlist = headerlists.get(header_key)
+            lookup._cache_key = _generate_cache_key(lookup.request, 'GET', headerlist, self.key_prefix) \
+                if headerlist is not None else None
+
+        pending = [lookup for lookup in lookups if lookup._validators is _MISSING and lookup.cache_key is not None]
+        validators_keys = [get_validators_cache_key(lookup.cache_key) for lookup in pending]
+        validators = get_many(self.cache, list(set(validators_keys))) if validators_keys else {}
+        for lookup, validators_key in zip(pending, validators_keys):
+            lookup._validators = validators.get(validators_key)
+
+        pending = [lookup for lookup in lookups if lookup._response is _MISSING and lookup.freshness == FRESH]
+        responses = get_many(self.cache, list(set(lookup.cache_key for lookup in pending))) if pending else {}
+        for lookup in pending:
+            lookup.set_response(responses.get(lookup.cache_key))
 
     def process_request(self, request):
         response = self.check_cache(request)
@@ -21,23 +222,19 @@ class CacheManager(object):
 
     def check_cache(self, request):
         """
-        Checks whether the page is already cached and returns the cached
-        version if available.
+        Checks whether the page is already cached and fresh, and returns the
+        cached version if so.
         """
         if not request.method in ('GET', 'HEAD'):
             request._cache_update_cache = False
             return None # Don't bother checking the cache.
 
         # try and get the cached GET response
-        cache_key = get_cache_key(request, self.key_prefix, 'GET', cache=self.cache)
-        if cache_key is None:
+        lookup = self.get_lookup(request)
+        if lookup.freshness != FRESH:
             request._cache_update_cache = True
-            return None # No cache information available, need to rebuild.
-        response = self.cache.get(cache_key, None)
-        # if it wasn't found and we are looking for a HEAD, try looking just for that
-        if response is None and request.method == 'HEAD':
-            cache_key = get_cache_key(request, self.key_prefix, 'HEAD', cache=self.cache)
-            response = self.cache.get(cache_key, None)
+            return None # No fresh cache information available, need to rebuild or revalidate.
+        response = lookup.response
 
         if response is None:
             request._cache_update_cache = True
@@ -47,6 +244,17 @@ class CacheManager(object):
         request._cache_update_cache = False
         return response
 
+    def get_flight_key(self, request):
+        """
+        Returns the key used to coalesce concurrent fetches of the same
+        request. It is the cache key, including the headers named in Vary,
+        when that is known, else a key over all of the request headers.
+        """
+        cache_key = self.get_lookup(request).cache_key
+        if cache_key is None:
+            cache_key = _generate_cache_key(request, request.method, sorted(request.headers), self.key_prefix)
+        return cache_key
+
     def patch_if_modified_since_header(self, request):
         """
         Add 'If-Modified-Since' header to request if:
@@ -54,12 +262,10 @@ class CacheManager(object):
         2. Previous response has 'Last-Modified' header.
         """
         if 'If-Modified-Since' not in request.headers:
-            cache_key = get_cache_key(request, CACHE_MANAGER_LONG_TERM_CACHE_KEY_PREFIX+self.key_prefix, 'GET', cache=self.cache)
-            if cache_key is not None:
-                response = self.cache.get(cache_key, None)
-                if response is not None:
-                    if response.has_header('Last-Modified'):
-                        request.headers['If-Modified-Since'] = response['Last-Modified']
+            lookup = self.get_lookup(request)
+            if lookup.freshness == STALE:
+                if 'Last-Modified' in lookup.validators:
+                    request.headers['If-Modified-Since'] = lookup.validators['Last-Modified']
 
     def patch_if_none_match_header(self, request):
         """
@@ -68,18 +274,13 @@ class CacheManager(object):
         2. Previous response has 'ETag' header.
         """
         if 'If-None-Match' not in request.headers:
-            cache_key = get_cache_key(request, CACHE_MANAGER_LONG_TERM_CACHE_KEY_PREFIX+self.key_prefix, 'GET', cache=self.cache)
-            if cache_key is not None:
-                response = self.cache.get(cache_key, None)
-                if response is not None:
-                    if response.has_header('ETag'):
-                        request.headers['If-None-Match'] = response['ETag']
+            lookup = self.get_lookup(request)
+            if lookup.freshness == STALE:
+                if 'ETag' in lookup.validators:
+                    request.headers['If-None-Match'] = lookup.validators['ETag']
 
     def process_304_response(self, request, response):
-        cache_key = get_cache_key(request, CACHE_MANAGER_LONG_TERM_CACHE_KEY_PREFIX+self.key_prefix, 'GET', cache=self.cache)
-        if cache_key is None:
-            return None
-        cached_response = self.cache.get(cache_key, None)
+        cached_response = self.get_lookup(request).response
         if cached_response is None:
             return None
         else:
@@ -100,40 +301,56 @@ class CacheManager(object):
         return True
 
     def process_response(self, request, response):
-        """Update cache if cache-control is not no-cache"""
-        cache_control = response.headers.get('Cache-Control')
-        if cache_control is not None and 'no-cache' not in cache_control:
-            self.update_cache(request, response)
+        """Update cache if cache-control allows it"""
+        cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+        if cache_control.no_store or cache_control.no_cache or (self.shared and cache_control.private):
+            return
+        self.update_cache(request, response)
 
     def update_cache(self, request, response):
         """Sets the cache, if needed."""
         if not self._should_update_cache(request, response):
             # We don't need to update the cache, just return.
             return response
+        # Get the timeout from the "s-maxage" or "max-age" sections of the
+        # "Cache-Control" header, then from the "Expires" header, then from
+        # the "Last-Modified" header. Without any of them there is no telling
+        # how long the response stays fresh, so don't cache it.
+        timeout = get_freshness_lifetime(response, shared=self.shared)
+        if timeout is None:
+            return response
         if response.status_code/100 != 2 and response.status_code/100 != 4 and response.status_code != 304:
             return response
-        # Try to get the timeout from the "max-age" section of the "Cache-
-        # Control" header before reverting to using the default cache_timeout
-        # length.
-        timeout = get_max_age(response)
-        if timeout == None:
-            timeout = self.cache_timeout
-        elif timeout == 0:
-            # max-age was set to 0, don't bother caching.
+        age = get_current_age(response)
+        if timeout <= age:
+            # The response is stale already, don't bother caching.
             return response
 #        patch_response_headers(response, timeout)
         if timeout:
-            cache_key = learn_cache_key(request, response, timeout, self.key_prefix, cache=self.cache)
-            long_term_cache_key = learn_cache_key(request, response, CACHE_MANAGER_LONG_TERM_CACHE_SECONDS, CACHE_MANAGER_LONG_TERM_CACHE_KEY_PREFIX+self.key_prefix, cache=self.cache)
+            # One entry per response, kept past its freshness lifetime so it can be revalidated
+            entry_timeout = timeout - age + CACHE_MANAGER_LONG_TERM_CACHE_SECONDS
+            cache_key = learn_cache_key(request, response, entry_timeout, self.key_prefix, cache=self.cache)
             if hasattr(response, 'render') and callable(response.render):
 
                 # TODO: Investigate 'post_render_callback'
                 def post_render_callback(r):
-                    self.cache.set(cache_key, r, timeout)
-                    self.cache.set(long_term_cache_key, r, CACHE_MANAGER_LONG_TERM_CACHE_SECONDS)
+                    self._set_entry(cache_key, r, timeout, age, entry_timeout)
 
                 response.add_post_render_callback(post_render_callback)
             else:
-                self.cache.set(cache_key, response, timeout)
-                self.cache.set(long_term_cache_key, response, CACHE_MANAGER_LONG_TERM_CACHE_SECONDS)
+                self._set_entry(cache_key, response, timeout, age, entry_timeout)
         return response
+
+    def _set_entry(self, cache_key, response, timeout, age, entry_timeout):
+        validators_cache_key = get_validators_cache_key(cache_key)
+        validators = get_validators(response, timeout, age)
+        if self.body_store is not None and response.content is not None:
+            # Keep the body in the body store and only a reference to it in the entry
+            previous_validators = self.cache.get(validators_cache_key, None)
+            validators['body'] = self.body_store.add(cache_key, response.content, entry_timeout)
+            if previous_validators is not None and previous_validators.get('body') not in (None, validators['body']):
+                self.body_store.release(cache_key, previous_validators['body'])
+            response = copy.copy(response)
+            response._content = None
+        self.cache.set(cache_key, response, entry_timeout)
+        self.cache.set(validators_cache_key, validators, entry_timeout)
@@ -0,0 +1,220 @@
+import copy
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import cookiejar_from_dict
+from requests.exceptions import RequestException
+from requests.structures import CaseInsensitiveDict
+
+from dogbutler.cache import CacheManager
+from dogbutler.cookie import CookieManager
+from dogbutler.defaults import get_default_cache, get_default_cookie_cache, get_default_redirect_cache
+from dogbutler.models import Request
+from dogbutler.pool import SingleFlight
+from dogbutler.redirect import RedirectManager
+
+
+DEFAULT_KEY_PREFIX = 'dogbutler'
+DEFAULT_COOKIE_KEY_PREFIX = 'cookie'
+DEFAULT_REDIRECT_KEY_PREFIX = 'redirect'
+
+DEFAULT_POOL_CONNECTIONS = 10       # Number of per-host connection pools to keep
+DEFAULT_POOL_MAXSIZE = 10           # Number of keep-alive connections to keep in each pool
+
+
+class Client(object):
+    """
+    A client holds one pooled requests.Session, so connections to the same host
+    are kept alive and reused across calls, along with its own cache, cookie and
+    redirect managers.
+
+    Any cache left as None follows the corresponding default cache in
+    dogbutler.defaults, even if that default is replaced later.
+    A body_store keeps identical response bodies only once.
+    A cookie_sweep_interval cleans up expired cookies in a background thread.
+    A cookie_snapshot keeps cookies across restarts.
+    Set shared_cache when the cache is shared between users, so s-maxage
+    applies and private responses are not cached.
+    """
+
+    def __init__(self, cache=None, cookie_cache=None, redirect_cache=None,
+                 key_prefix=DEFAULT_KEY_PREFIX, cookie_key_prefix=DEFAULT_COOKIE_KEY_PREFIX,
+                 redirect_key_prefix=DEFAULT_REDIRECT_KEY_PREFIX,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 body_store=None, cookie_sweep_interval=None, cookie_snapshot=None, shared_cache=False):
+        self.cache = cache
+        self.cookie_cache = cookie_cache
+        self.redirect_cache = redirect_cache
+        self.key_prefix = key_prefix
+        self.cookie_key_prefix = cookie_key_prefix
+        self.redirect_key_prefix = redirect_key_prefix
+        self.body_store = body_store
+        self.cookie_sweep_interval = cookie_sweep_interval
+        self.cookie_snapshot = cookie_snapshot
+        self.shared_cache = shared_cache
+
+        self.session = requests.Session()
+        for prefix in ('http://', 'https://'):
+            self.session.mount(prefix, HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize))
+
+        self._cache_manager = None
+        self._cookie_manager = None
+        self._redirect_manager = None
+        self._flights = SingleFlight()
+
+    @property
+    def cache_manager(self):
+        cache = self.cache or get_default_cache()
+        if self._cache_manager is None or self._cache_manager.cache is not cache:
+            self._cache_manager = CacheManager(key_prefix=self.key_prefix, cache=cache, body_store=self.body_store,
+                                               shared=self.shared_cache)
+        return self._cache_manager
+
+    @property
+    def cookie_manager(self):
+        cache = self.cookie_cache or get_default_cookie_cache()
+        if self._cookie_manager is None or self._cookie_manager.cache is not cache:
+            if self._cookie_manager is not None:
+                self._cookie_manager.close()
+            self._cookie_manager = CookieManager(key_prefix=self.cookie_key_prefix, cache=cache,
+                                                 sweep_interval=self.cookie_sweep_interval,
+                                                 snapshot=self.cookie_snapshot)
+        return self._cookie_manager
+
+    @property
+    def redirect_manager(self):
+        cache = self.redirect_cache or get_default_redirect_cache()
+        if self._redirect_manager is None or self._redirect_manager.cache is not cache:
+            self._redirect_manager = RedirectManager(key_prefix=self.redirect_key_prefix, cache=cache)
+        return self._redirect_manager
+
+    def get(self, url, queue=None, **kwargs):
+        request, response = self.process_request(url, **kwargs)
+        if response is None:
+            response = self.fetch(request, **kwargs)
+
+        if queue: queue.put(response)
+        return response
+
+    def fetch(self, request, **kwargs):
+        """
+        Send a request that process_request could not answer from cache.
+        Identical concurrent misses share a single fetch.
+        """
+        flight_key = self.cache_manager.get_flight_key(request)
+        return self._flights.do(flight_key, self.send, request, **kwargs)
+
+    def process_request(self, url, **kwargs):
+        """
+        Run the request side of the pipeline without touching the network.
+        Returns a tuple of (request, response) where response is the cached
+        response, or None if request has to be sent.
+        """
+
+        # Convert to Request object
+        request = Request(url, method='GET', **kwargs)
+
+        # Process request
+        self.redirect_manager.process_request(request)              # Redirect if previously got 301
+        self.cookie_manager.process_request(request)                # Set cookies
+        response = self.cache_manager.process_request(request)      # Get from cache if conditions are met
+        return request, response
+
+    def process_requests(self, batch):
+        """
+        Run process_request for a batch of requests, each a tuple of (url,
+        kwargs), reading the cache in bulk. Returns a list of (request,
+        response) tuples in the same order. A request whose request side
+        failed comes back as (None, None), to be retried with get().
+        """
+        prepared = []
+        for url, kwargs in batch:
+            try:
+                request = Request(url, method='GET', **kwargs)
+            except Exception:
+                request = None
+            prepared.append(request)
+
+        redirect_manager = self.redirect_manager
+        redirect_manager.prefetch([request for request in prepared if request is not None])
+        for i, request in enumerate(prepared):
+            if request is None:
+                continue
+            try:
+                redirect_manager.process_request(request)
+                self.cookie_manager.process_request(request)
+            except Exception:
+                prepared[i] = None
+
+        cache_manager = self.cache_manager
+        cache_manager.prefetch([request for request in prepared if request is not None])
+        return [(request, cache_manager.process_request(request) if request is not None else None)
+                for request in prepared]
+
+    def _call_session(self):
+        """
+        Return a shallow copy of the session for a single call. It shares the
+        session's connection pools but has a cookie jar of its own, so a
+        cookie set on one redirect hop is sent on the next, as requests does,
+        and is dropped with the copy once the call is over.
+        """
+        session = copy.copy(self.session)
+        session.cookies = cookiejar_from_dict({})
+        return session
+
+    def send(self, request, **kwargs):
+        """
+        Send a request returned by process_request and run the response side
+        of the pipeline.
+        """
+
+        # Get managers
+        cache_manager = self.cache_manager
+        cookie_manager = self.cookie_manager
+        redirect_manager = self.redirect_manager
+        session = self._call_session()
+        original_kwargs = dict(kwargs)
+
+        # Update kwargs
+        if request.headers: kwargs['headers'] = request.headers     # Update kwargs with new headers
+        kwargs.pop('cookies', None)                                 # Merged into the Cookie header already
+
+        # Make a request
+        try:
+            response = session.get(request.url, **kwargs)
+        except RequestException:
+            if not redirect_manager.fallback(request):
+                raise
+            response = None
+        if response is None or redirect_manager.fallback(request, response):
+            # The host was wrongly predicted to rewrite the URL, start over with the original one
+            request, response = self.process_request(request.rewritten_from, **original_kwargs)
+            if response is not None:
+                return response
+            return self.send(request, **original_kwargs)
+
+        # Process response
+        redirect_manager.process_response(request, response)        # Save redirect info
+
+        # Handle 304
+        if response.status_code == 304:
+            cached_response = cache_manager.process_304_response(request, response)
+            if cached_response is not None:
+                response = cached_response
+            else:
+                # Nothing cached to answer with, ask again without the validators the cache added.
+                # A 304 to the caller's own conditional request is theirs to handle.
+                caller_headers = CaseInsensitiveDict(original_kwargs.get('headers') or {})
+                if 'If-Modified-Since' not in caller_headers and 'If-None-Match' not in caller_headers:
+                    headers = request.headers.copy()
+                    if 'If-Modified-Since' in headers: del headers['If-Modified-Since']
+                    if 'If-None-Match' in headers: del headers['If-None-Match']
+                    request.headers = headers
+                    if headers: kwargs['headers'] = headers
+                    else: kwargs.pop('headers', None)
+                    response = session.get(request.url, **kwargs)
+
+        cookie_manager.process_response(request, response)          # Handle cookie
+        cache_manager.process_response(request, response)           # Update cache as necessary
+
+        return response
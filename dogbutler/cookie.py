@@ -1,40 +1,181 @@
-from Cookie import SimpleCookie
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from Cookie import Morsel
+from datetime import datetime, timedelta
 import re
+from threading import Event, Lock, RLock, Thread
+import time
 from urlparse import urlparse
 
+from dogbutler.utils.cache import delete_many, get_many, set_many
+from dogbutler.utils.http import format_cookie_date, parse_cookie_date
+from dogbutler.utils.publicsuffix import get_registrable_domain, is_public_suffix
 
-ORIGIN_KEY_PREFIX = 'origin'
-
-def _make_cookie(cookie_headers):
-    def _add_dash(match_obj):
-        return match_obj.group(0).replace(' ', '-')
 
-    cookie = SimpleCookie()
-    set_cookie_str = re.sub(r'\d{2}\s\w+\s\d{4}', _add_dash, cookie_headers)
-    cookie.load(set_cookie_str)
-
-    return  cookie
+ORIGIN_KEY_PREFIX = 'origin'
+COOKIE_INDEX_TTL = 60       # Seconds before an index entry is read again from the cache
+COOKIE_INDEX_MAX_ENTRIES = 10000    # Number of lookup sets the index keeps, stale and oldest dropped first
+COOKIE_HEADER_MEMO_SIZE = 1024  # Number of (host, path) Cookie headers to remember
+LOOKUP_LOCK_STRIPES = 64        # Number of locks the lookup set updates are spread over
+MAX_COOKIES_PER_DOMAIN = 50     # RFC 6265 section 6.1 asks for at least 50 cookies per domain
+MAX_COOKIES = 3000              # and at least 3000 cookies in total
+MAX_PENDING_EXPIRED = 1000      # Expired cookie keys held back before a read writes them back
+
+# Splits folded Set-Cookie headers: a comma only starts a new cookie if it is
+# followed by 'name=', which a comma inside an Expires date never is
+_set_cookie_split_re = re.compile(r',(?=\s*[^\s;,=]+\s*=)')
+
+class CookieRecord(object):
+    """
+    A cookie parsed from a Set-Cookie header.
+
+    Item lookups ('domain', 'path', 'expires', 'max-age', 'secure' and
+    'httponly') answer like they would on a Cookie.Morsel. In cache, it is
+    stored as the plain tuple returned by dump_cookie().
+    """
+    __slots__ = ('key', 'value', 'domain', 'path', 'expires', 'max_age', 'secure', 'httponly', 'expiry')
+
+    def __init__(self, key, value, domain='', path='', expires=None, max_age=None, secure=False, httponly=False):
+        self.key = key
+        self.value = value
+        self.domain = domain
+        self.path = path
+        self.expires = expires      # Timestamp, or None
+        self.max_age = max_age      # Seconds, or None
+        self.secure = secure
+        self.httponly = httponly
+        self.expiry = None          # When the cookie was stored to expire, or None
+
+    def __getitem__(self, attr):
+        if attr == 'expires':
+            return format_cookie_date(self.expires) if self.expires is not None else ''
+        elif attr == 'max-age':
+            return str(self.max_age) if self.max_age is not None else ''
+        elif attr in ('domain', 'path', 'secure', 'httponly'):
+            return getattr(self, attr)
+        raise KeyError(attr)
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        self.expiry = None          # Not in records stored before it was added
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+    def __repr__(self):
+        return '<CookieRecord: %s=%s>' % (self.key, self.value)
+
+
+def dump_cookie(cookie):
+    """
+    Return cookie as the plain tuple it is stored as in cache, which pickles
+    smaller and loads faster than a class instance.
+    """
+    return cookie.__getstate__()
+
+def load_cookie(record):
+    """
+    Return the CookieRecord for a tuple made by dump_cookie, or for a
+    Cookie.Morsel as stored by earlier versions. Anything else is treated as
+    missing, and gives None.
+    """
+    if record is None or isinstance(record, CookieRecord):
+        return record
+    if isinstance(record, Morsel):
+        return _load_morsel(record)
+    if not isinstance(record, tuple) or len(record) > len(CookieRecord.__slots__):
+        return None
+    cookie = CookieRecord.__new__(CookieRecord)
+    cookie.__setstate__(record)
+    return cookie
+
+def _load_morsel(morsel):
+    """
+    Return a CookieRecord with the attributes of a Cookie.Morsel.
+    """
+    if not morsel.key:
+        return None
+    cookie = CookieRecord(morsel.key, morsel.value, domain=morsel['domain'], path=morsel['path'],
+                          secure=bool(morsel['secure']), httponly=bool(morsel['httponly']))
+    if morsel['expires']:
+        cookie.expires = parse_cookie_date(str(morsel['expires']))
+    if str(morsel['max-age']).lstrip('-').isdigit():
+        cookie.max_age = int(morsel['max-age'])
+    return cookie
+
+
+def parse_set_cookie(set_cookie_header):
+    """
+    Return a list of CookieRecords from a Set-Cookie header, which may hold
+    several cookies folded together with commas. Cookies and attributes that
+    cannot be parsed are skipped, as RFC 6265 section 5.2 asks.
+    """
+    cookies = []
+    for set_cookie_string in _set_cookie_split_re.split(set_cookie_header):
+        parts = set_cookie_string.split(';')
+        name, sep, value = parts[0].partition('=')
+        name = name.strip()
+        if not sep or not name:
+            continue
+        cookie = CookieRecord(name, value.strip())
+
+        for part in parts[1:]:
+            attr, sep, attr_value = part.partition('=')
+            attr = attr.strip().lower()
+            attr_value = attr_value.strip()
+            if attr == 'expires':
+                cookie.expires = parse_cookie_date(attr_value)
+            elif attr == 'max-age':
+                if attr_value.lstrip('-').isdigit():
+                    cookie.max_age = int(attr_value)
+            elif attr == 'domain':
+                cookie.domain = attr_value
+            elif attr == 'path':
+                cookie.path = attr_value if attr_value.startswith('/') else ''
+            elif attr == 'secure':
+                cookie.secure = True
+            elif attr == 'httponly':
+                cookie.httponly = True
+        cookies.append(cookie)
+    return cookies
 
 def get_max_age(cookie):
-    max_age = None
+    """
+    Return the number of seconds cookie should be kept for, or None if it
+    should be kept for the session.
+    """
+    # max-age has higher priority than expires
+    if cookie.max_age is not None:
+        return cookie.max_age
     # convert expires to seconds, so we use take advantage of cache expiry feature,
     # no need to clear cookie ourselves
-    if cookie['expires']:
-        fmt = '%a, %d-%b-%Y %H:%M:%S GMT'
-        try:
-            expired  = datetime.strptime(cookie['expires'], fmt)
-            now = datetime.utcnow()
-            max_age = (expired - now).total_seconds()
-        except ValueError:
-            # if cookie has wrong date format we ignore the expires
-            cookie['expires'] = ''
-            max_age = None
-
-    # max-age has higher priority than  expires
-    if cookie['max-age']:
-        max_age = int(cookie['max-age'])
-    return max_age
+    if cookie.expires is not None:
+        return cookie.expires - time.time()
+    return None
+
+def merge_cookies(cookies, request_cookies, cookie_header):
+    """
+    Return a tuple of (cookies, header) for the cookies stored for a URL,
+    merged with the ones a request came with: request_cookies, a dictionary
+    or a CookieJar, and cookie_header, the Cookie header it already had. The
+    latter take precedence, and the header is kept as it was given.
+    """
+    cookies = dict(cookies)
+    if request_cookies:
+        if not isinstance(request_cookies, dict):
+            request_cookies = dict((cookie.name, cookie.value) for cookie in request_cookies)
+        cookies.update(request_cookies)
+    header_names = set()
+    if cookie_header:
+        for pair in cookie_header.split(';'):
+            name, sep, value = pair.partition('=')
+            if sep and name.strip():
+                header_names.add(name.strip())
+                cookies[name.strip()] = value.strip()
+    pairs = ['%s=%s' % (name, value) for name, value in sorted(cookies.items()) if name not in header_names]
+    header = '; '.join(([cookie_header] if cookie_header else []) + pairs)
+    return cookies, header
 
 def is_domain_valid(domain):
     if domain.endswith('.'):
@@ -48,32 +189,419 @@ def normalize_domain(domain):
 def normalize_path(path):
     return path.rstip('/') if path != '/' else path
 
+def path_matches(cookie_path, request_path):
+    """
+    Return True if a cookie with cookie_path should be sent for request_path.
+    """
+    if not cookie_path or cookie_path == '/':
+        return True
+
+    if not request_path.startswith('/'):
+        request_path = '/' + request_path
+
+    if request_path == cookie_path:
+        return True
+    elif cookie_path.endswith('/') and request_path.startswith(cookie_path):
+        return True
+    elif request_path.startswith(cookie_path) and request_path[len(cookie_path)] == '/':
+        return True
+    else:
+        return False
+
+
+class _CookieIndexEntry(object):
+    """
+    The cookie keys in one lookup set, grouped by cookie path. Keys loaded
+    from the cache are filed under None until their cookie has been read and
+    its path is known.
+    """
+    __slots__ = ('loaded', 'paths')
+
+    def __init__(self, cookie_keys):
+        self.loaded = time.time()
+        self.paths = {None: set(cookie_keys)} if cookie_keys else {}
+
+    def add(self, cookie_key, path):
+        self.discard(cookie_key)
+        self.paths.setdefault(path, set()).add(cookie_key)
+
+    def discard(self, cookie_key):
+        for cookie_keys in self.paths.values():
+            cookie_keys.discard(cookie_key)
+
+    def match(self, request_path):
+        for path, cookie_keys in self.paths.items():
+            if path is None or path_matches(path, request_path):
+                for cookie_key in cookie_keys:
+                    yield cookie_key
+
+    def is_empty(self):
+        return not any(self.paths.values())
+
+
+class _CookieIndexNode(object):
+    __slots__ = ('children', 'origin', 'domain')
+
+    def __init__(self):
+        self.children = {}
+        self.origin = None      # _CookieIndexEntry for origin cookies, None until loaded
+        self.domain = None      # _CookieIndexEntry for domain cookies, None until loaded
+
+
+class CookieIndex(object):
+    """
+    In-memory index of cookie keys, organised as a trie on reversed domain
+    labels ('www.test.com' is found under 'com', 'test', 'www'), with the
+    origin and domain cookies of each node grouped by path. Every cookie key
+    that may apply to a URL is found in a single walk from the root.
+
+    The index mirrors the lookup sets in the cache, which stay the source of
+    truth: each entry is loaded from its lookup set on first use, and again
+    once it is older than ttl seconds to pick up changes made elsewhere.
+
+    Only lookup sets with cookie keys in them get an entry, the ones found
+    empty are merely remembered as such for ttl seconds. Past max_entries
+    entries, stale and empty ones are dropped, then the oldest ones, along
+    with the nodes left with nothing under them. Methods other than lock
+    must be called with lock held.
+    """
+
+    def __init__(self, ttl=COOKIE_INDEX_TTL, max_entries=COOKIE_INDEX_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.root = _CookieIndexNode()
+        self.size = 0           # Number of entries in the trie
+        self.empty = {}         # (domain, kind) -> when its lookup set was found empty
+        self.lock = RLock()
+
+    def walk(self, domain):
+        """
+        Return the nodes for each suffix of domain, from the TLD down to
+        domain itself, creating them as needed.
+        """
+        nodes = []
+        node = self.root
+        for label in reversed(domain.split('.')):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _CookieIndexNode()
+            node = child
+            nodes.append(node)
+        return nodes
+
+    def find(self, domain):
+        """
+        Return the node for domain, or None if it has never been walked.
+        """
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                return None
+        return node
+
+    def get(self, domain, kind):
+        """
+        Return the entry of kind ('origin' or 'domain') for domain, or None.
+        """
+        node = self.find(domain)
+        return getattr(node, kind) if node is not None else None
+
+    def is_stale(self, domain, kind):
+        """
+        Return True if the lookup set of kind for domain has to be read from
+        the cache.
+        """
+        entry = self.get(domain, kind)
+        loaded = entry.loaded if entry is not None else self.empty.get((domain, kind))
+        return loaded is None or time.time() - loaded >= self.ttl
+
+    def load(self, domain, kind, cookie_keys):
+        """
+        Set the entry of kind for domain to the cookie keys just read from its
+        lookup set, which may be None or empty. Returns the new entry, or None
+        if there are no cookie keys.
+        """
+        if not cookie_keys:
+            self.remove(domain, kind)
+            if len(self.empty) >= self.max_entries:
+                self.empty.clear()
+            self.empty[(domain, kind)] = time.time()
+            return None
+        self.empty.pop((domain, kind), None)
+        node = self.walk(domain)[-1]
+        if getattr(node, kind) is None:
+            self.size += 1
+        entry = _CookieIndexEntry(cookie_keys)
+        setattr(node, kind, entry)
+        if self.size > self.max_entries:
+            self.prune(keep=entry)
+        return entry
+
+    def add(self, domain, kind, cookie_key, path):
+        """
+        Add cookie_key to the entry of kind for domain, if its lookup set has
+        been read.
+        """
+        entry = self.get(domain, kind)
+        if entry is None:
+            loaded = self.empty.get((domain, kind))
+            if loaded is None:
+                return
+            entry = self.load(domain, kind, [cookie_key])
+            entry.loaded = loaded
+        entry.add(cookie_key, path)
+
+    def remove(self, domain, kind, entry=None):
+        """
+        Remove the entry of kind for domain, only if it is still entry when
+        one is given, and the nodes left with nothing under them.
+        """
+        labels = list(reversed(domain.split('.')))
+        nodes = [self.root]
+        for label in labels:
+            node = nodes[-1].children.get(label)
+            if node is None:
+                return
+            nodes.append(node)
+        current = getattr(nodes[-1], kind)
+        if current is None or (entry is not None and current is not entry):
+            return
+        setattr(nodes[-1], kind, None)
+        self.size -= 1
+        for parent, label, node in reversed(zip(nodes, labels, nodes[1:])):
+            if node.children or node.origin is not None or node.domain is not None:
+                break
+            del parent.children[label]
+
+    def prune(self, keep=None):
+        """
+        Drop the stale and empty entries, then the oldest ones until at most
+        three quarters of max_entries are left if there are still more than
+        max_entries, never the entry keep.
+        """
+        now = time.time()
+        for key, loaded in self.empty.items():
+            if now - loaded >= self.ttl:
+                del self.empty[key]
+        for domain, kind, entry in list(self.entries()):
+            if entry.is_empty() or now - entry.loaded >= self.ttl:
+                self.remove(domain, kind, entry)
+        if self.size > self.max_entries:
+            entries = sorted((entry.loaded, domain, kind, entry) for domain, kind, entry in self.entries()
+                             if entry is not keep)
+            for loaded, domain, kind, entry in entries[:self.size - self.max_entries * 3 / 4]:
+                self.remove(domain, kind, entry)
+
+    def entries(self):
+        """
+        Yield a tuple of (domain, kind, entry) for every loaded entry, where
+        kind is 'origin' or 'domain'.
+        """
+        stack = [(self.root, [])]
+        while stack:
+            node, labels = stack.pop()
+            domain = '.'.join(reversed(labels))
+            for kind in ('origin', 'domain'):
+                entry = getattr(node, kind)
+                if entry is not None:
+                    yield domain, kind, entry
+            for label, child in node.children.items():
+                stack.append((child, labels + [label]))
+
+
+class CookieSweeper(Thread):
+    """
+    Daemon thread that calls manager.sweep() every interval seconds, so
+    expired cookie keys are removed from the lookup sets in the background
+    instead of by the reads that find them.
+    """
+
+    def __init__(self, manager, interval):
+        super(CookieSweeper, self).__init__()
+        self.daemon = True
+        self.manager = manager
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.manager.sweep()
+            except Exception:
+                # A cache that is down for a moment must not stop the sweeping
+                pass
+
+    def stop(self):
+        self.stopped.set()
 
-class CookieManager(object):
 
-    def __init__(self, key_prefix, cache):
+class CookieManager(object):
+    """
+    Cookie keys found expired on a read are only marked in memory. They are
+    written back to their lookup sets by flush(), which runs when cookies are
+    next set, or on a read once max_pending_expired keys are waiting. With a
+    sweep_interval, a CookieSweeper flushes them in the background instead,
+    and reads never write to the cache.
+
+    At most max_cookies_per_domain cookies are kept in each lookup set, and
+    at most max_cookies in total. Past either limit, the least recently used
+    cookies are evicted, and counted in domain_evictions and global_evictions.
+
+    With a CookieSnapshot, the cookies of each lookup set are loaded from it
+    into cache the first time the lookup set is used, and save() writes the
+    cookies back to it. Which lookup sets were loaded is forgotten past
+    index_max_entries of them, loading one again only adds the cookies the
+    cache has not seen.
+    """
+
+    def __init__(self, key_prefix, cache, index_ttl=COOKIE_INDEX_TTL, sweep_interval=None,
+                 max_cookies_per_domain=MAX_COOKIES_PER_DOMAIN, max_cookies=MAX_COOKIES, snapshot=None,
+                 index_max_entries=COOKIE_INDEX_MAX_ENTRIES, max_pending_expired=MAX_PENDING_EXPIRED):
         self.key_prefix = key_prefix
         self.cache = cache
+        self.snapshot = snapshot
+        self._snapshot_loaded = set()   # Lookup keys already loaded from the snapshot
+        self._snapshot_removed = set()  # Cookie keys to delete from the snapshot on save
+        self.index = CookieIndex(ttl=index_ttl, max_entries=index_max_entries)
+        self.max_cookies_per_domain = max_cookies_per_domain
+        self.max_cookies = max_cookies
+        self.max_pending_expired = max_pending_expired
+        self.domain_evictions = 0
+        self.global_evictions = 0
+        self._lru = OrderedDict()   # Cookie key -> lookup key, least recently used first
+        self._expired = {}      # Lookup key -> cookie keys to remove from its lookup set
+        self._cookie_headers = {}   # (host, path) -> (cookies, header, expires)
+        self._generation = 0        # Bumped whenever a cookie is set
+        self._lookup_locks = [Lock() for _ in range(LOOKUP_LOCK_STRIPES)]
+
+        self.sweeper = None
+        if sweep_interval:
+            self.sweeper = CookieSweeper(self, sweep_interval)
+            self.sweeper.start()
+
+    def close(self):
+        """
+        Stop the background sweeper, if any, and write back what it had
+        pending, to the snapshot too if there is one.
+        """
+        if self.sweeper is not None:
+            self.sweeper.stop()
+            self.sweeper = None
+        self.flush()
+        self.save()
+
+    def save(self):
+        """
+        Save the cookies this process has used or set to the snapshot, and
+        delete the ones that have expired or been evicted since.
+        """
+        if self.snapshot is None:
+            return
+        with self.index.lock:
+            lookup_keys = dict(self._lru)
+            for domain, kind, entry in self.index.entries():
+                lookup_key = self.get_lookup_key(kind, domain)
+                for cookie_keys in entry.paths.values():
+                    for cookie_key in cookie_keys:
+                        lookup_keys.setdefault(cookie_key, lookup_key)
+            removed_cookie_keys, self._snapshot_removed = self._snapshot_removed, set()
+
+        records = get_many(self.cache, lookup_keys.keys()) if lookup_keys else {}
+        cookies = []
+        for cookie_key, record in records.items():
+            cookie = load_cookie(record)
+            if cookie is None:
+                del records[cookie_key]
+                continue
+            expiry = cookie.expiry
+            expires = time.mktime(expiry.timetuple()) + expiry.microsecond / 1e6 if expiry is not None else None
+            cookies.append((cookie_key, lookup_keys[cookie_key], dump_cookie(cookie), expires))
+        removed_cookie_keys.update(cookie_key for cookie_key in lookup_keys if cookie_key not in records)
+        self.snapshot.save(cookies, removed_cookie_keys)
+
+    def _load_snapshot(self, lookup_keys):
+        """
+        Load the cookies under lookup_keys from the snapshot into cache, for
+        the lookup keys not loaded yet, leaving out the cookie keys already
+        in their lookup set or removed since the last save.
+        """
+        if self.snapshot is None:
+            return
+        with self.index.lock:
+            lookup_keys = [lookup_key for lookup_key in lookup_keys if lookup_key not in self._snapshot_loaded]
+            if len(self._snapshot_loaded) + len(lookup_keys) > self.index.max_entries:
+                self._snapshot_loaded.clear()
+            self._snapshot_loaded.update(lookup_keys)
+            removed_cookie_keys = set(self._snapshot_removed)
+        if not lookup_keys:
+            return
+
+        loaded = self.snapshot.load(lookup_keys)
+        if not loaded:
+            return
+
+        # The cache knows better about the cookies it has seen, even once expired
+        cookie_keys_sets = get_many(self.cache, loaded.keys())
+        now = time.time()
+        added_cookie_keys_sets = {}
+        for lookup_key, cookies in loaded.items():
+            known_cookie_keys = cookie_keys_sets.get(lookup_key) or ()
+            for cookie_key, record, expires in cookies:
+                if cookie_key in known_cookie_keys or cookie_key in removed_cookie_keys:
+                    continue
+                timeout = expires - now if expires is not None else None
+                self.cache.set(cookie_key, record, timeout)
+                added_cookie_keys_sets.setdefault(lookup_key, set()).add(cookie_key)
+        if added_cookie_keys_sets:
+            self._add_to_lookup_sets(added_cookie_keys_sets)
 
     def process_request(self, request):
         """
-        Set 'Cookie' header in request
+        Set 'Cookie' header in request, merging the cookies it came with
         """
-        request.cookies = self.get_cookies(request.url)
+        cookies, cookie_header = self.get_cookie_header(request.url)
+        if request.cookies or 'Cookie' in request.headers:
+            cookies, cookie_header = merge_cookies(cookies, request.cookies, request.headers.get('Cookie'))
+        request.cookies = dict(cookies)
+        if cookie_header:
+            request.headers['Cookie'] = cookie_header
 
     def process_response(self, request, response):
         """
-        Process 'Set-Cookie' header in response
+        Process 'Set-Cookie' header in response, and in every redirect that
+        led to it, each for its own URL
         """
-        if response and response.has_header('Set-Cookie'):
-            origin = urlparse(response.url).netloc
-            cookies = _make_cookie(response.headers['Set-Cookie'])
-            for name, cookie in cookies.items():
-                domain = cookie['domain']
-                if not domain:
-                    self.set_origin_cookie(origin, cookie)
-                else:
-                    self.set_domain_cookie(cookie)
+        if not response:
+            return
+        cookies = []
+        for r in list(response.history) + [response]:
+            if r.has_header('Set-Cookie'):
+                cookies.extend(self._get_set_cookies(r))
+        if cookies:
+            self._set_cookies(cookies)
+
+    def _get_set_cookies(self, response):
+        """
+        Return the cookies in the 'Set-Cookie' header of response as a list
+        of tuples of (kind, domain, cookie), for _set_cookies().
+        """
+        url = urlparse(response.url)
+        origin = url.netloc
+        cookies = []
+        for cookie in parse_set_cookie(response.headers['Set-Cookie']):
+            domain = cookie['domain']
+            if not domain:
+                cookies.append(('origin', origin, cookie))
+            elif not is_domain_valid(domain):
+                continue
+            elif not is_public_suffix(normalize_domain(domain)):
+                cookies.append(('domain', domain, cookie))
+            elif normalize_domain(domain).lower() == url.hostname:
+                # RFC 6265 section 5.3 step 5: a public suffix may only
+                # be the Domain of the host itself, as a host-only cookie
+                cookies.append(('origin', origin, cookie))
+        return cookies
 
     def get_domain_cookie_key(self, domain, path, name):
         return '%s.%s.%s.%s' % (self.key_prefix, normalize_domain(domain), path, name)
@@ -87,19 +615,121 @@ class CookieManager(object):
     def get_origin_cookie_lookup_key(self, origin):
         return '%s.%s.%s' % (self.key_prefix, ORIGIN_KEY_PREFIX, normalize_domain(origin))
 
+    def get_cookie_key(self, kind, domain, path, name):
+        if kind == 'origin':
+            return self.get_origin_cookie_key(domain, path, name)
+        return self.get_domain_cookie_key(domain, path, name)
+
+    def get_lookup_key(self, kind, domain):
+        if kind == 'origin':
+            return self.get_origin_cookie_lookup_key(domain)
+        return self.get_domain_cookie_lookup_key(domain)
+
     def get_cookies(self, url):
         """
         Return a dictionary (key:value) of cookies for the given URL
         """
-        domain = urlparse(url).netloc
+        return dict(self.get_cookie_header(url)[0])
+
+    def get_cookie_header(self, url):
+        """
+        Return a tuple of (cookies, header) for the given URL, where header is
+        the value of the Cookie header to send.
+
+        Both are remembered per (host, path) until a cookie is set, the first
+        of their cookies expires, or the index would read its lookup sets
+        again, whichever comes first. The cookies dictionary is shared and
+        must not be changed.
+        """
+        parsed_url = urlparse(url)
+        memo_key = (parsed_url.netloc, parsed_url.path)
+        now = datetime.now()
+        with self.index.lock:
+            memo = self._cookie_headers.get(memo_key)
+            generation = self._generation
+        if memo is not None and memo[2] > now:
+            return memo[0], memo[1]
+
+        cookies, expiry = self._find_cookies(url)
+        header = '; '.join('%s=%s' % (name, value) for name, value in sorted(cookies.items()))
+        expires = now + timedelta(seconds=self.index.ttl)
+        if expiry is not None and expiry < expires:
+            expires = expiry
+
+        with self.index.lock:
+            # A cookie set meanwhile may not be in cookies
+            if generation == self._generation:
+                if len(self._cookie_headers) >= COOKIE_HEADER_MEMO_SIZE:
+                    self._cookie_headers.clear()
+                self._cookie_headers[memo_key] = (cookies, header, expires)
+        return cookies, header
+
+    def _find_cookies(self, url):
+        """
+        Return a tuple of (cookies, expiry), where cookies is a dictionary
+        (key:value) of cookies for the given URL read through the index, and
+        expiry is when the first of them expires, or None.
+        """
+        url = urlparse(url)
+        domain = url.netloc
+        path = url.path
         domain_parts = domain.split('.')
-        path = urlparse(url).path
-        cookies = self.get_origin_cookies(domain, path)
-        for i in reversed(range(len(domain_parts))):
-            d = '.'.join(domain_parts[i:])
-            c = self.get_domain_cookies(d, path)
-            cookies.update(c)
-        return cookies
+
+        # No domain cookie can be set above the registrable domain
+        registrable_domain = get_registrable_domain(domain)
+        first = registrable_domain.count('.') if registrable_domain else len(domain_parts)
+
+        with self.index.lock:
+            # Origin cookies first, then domain cookies from the shortest domain
+            # to the longest, so that more specific cookies win
+            slots = [(self.get_origin_cookie_lookup_key(domain), domain, 'origin')]
+            for i in range(first, len(domain_parts)):
+                d = '.'.join(domain_parts[len(domain_parts)-i-1:])
+                slots.append((self.get_domain_cookie_lookup_key(d), d, 'domain'))
+            stale_lookup_keys = [lookup_key for lookup_key, d, kind in slots if self.index.is_stale(d, kind)]
+
+        # Load the lookup sets the index does not know yet, in one round trip
+        if stale_lookup_keys:
+            self._load_snapshot(stale_lookup_keys)
+            cookie_keys_sets = get_many(self.cache, stale_lookup_keys)
+        loaded = {}
+        with self.index.lock:
+            # Use the entries just loaded even if loading the next ones pruned them
+            for lookup_key, d, kind in slots:
+                if lookup_key in stale_lookup_keys:
+                    loaded[lookup_key] = self.index.load(d, kind, cookie_keys_sets.get(lookup_key))
+            entries = [(lookup_key, d, kind, loaded[lookup_key] if lookup_key in loaded else self.index.get(d, kind))
+                       for lookup_key, d, kind in slots]
+            matches = [(lookup_key, d, kind, entry, list(entry.match(path)))
+                       for lookup_key, d, kind, entry in entries if entry is not None]
+
+        cookie_keys = set()
+        for lookup_key, d, kind, entry, entry_cookie_keys in matches:
+            cookie_keys.update(entry_cookie_keys)
+        found_cookies = get_many(self.cache, list(cookie_keys)) if cookie_keys else {}
+
+        cookies = {}
+        expiry = None
+        expired_cookie_keys_sets = {}
+        with self.index.lock:
+            for lookup_key, d, kind, entry, entry_cookie_keys in matches:
+                for cookie_key in entry_cookie_keys:
+                    cookie = load_cookie(found_cookies.get(cookie_key))
+                    if cookie is None:
+                        entry.discard(cookie_key)
+                        expired_cookie_keys_sets.setdefault(lookup_key, set()).add(cookie_key)
+                        continue
+                    entry.add(cookie_key, cookie['path'])
+                    if path_matches(cookie['path'], path):
+                        cookies[cookie.key] = cookie.value
+                        self._touch(cookie_key, lookup_key)
+                        if cookie.expiry is not None and (expiry is None or cookie.expiry < expiry):
+                            expiry = cookie.expiry
+                if entry.is_empty():
+                    self.index.remove(d, kind, entry)
+
+        self._mark_expired(expired_cookie_keys_sets)
+        return cookies, expiry
 
     def get_domain_cookies(self, domain, path):
         """
@@ -117,73 +747,271 @@ class CookieManager(object):
         """
         Return a dictionary (key:value) of xxx cookies
         """
-        lookup_key = get_lookup_key_fn(domain)
-        cookie_keys_set = self.cache.get(lookup_key) or set()
+        return self._get_cookies([get_lookup_key_fn(domain)], path)
+
+    def _get_cookies(self, lookup_keys, path):
+        """
+        Return a dictionary (key:value) of cookies in the lookup sets under
+        lookup_keys, later lookup sets taking precedence. This takes one bulk
+        read for the lookup sets and one for the cookies. Expired cookies are
+        left to flush().
+        """
+        cookie_keys_sets = get_many(self.cache, lookup_keys)
+        cookie_keys = set()
+        for cookie_keys_set in cookie_keys_sets.values():
+            cookie_keys.update(cookie_keys_set)
+        found_cookies = get_many(self.cache, list(cookie_keys)) if cookie_keys else {}
+
         cookies = {}
-        expired_cookie_keys_set = set()
-        if cookie_keys_set:
+        expired_cookie_keys_sets = {}
+        for lookup_key in lookup_keys:
+            cookie_keys_set = cookie_keys_sets.get(lookup_key)
+            if not cookie_keys_set:
+                continue
+            expired_cookie_keys_set = set()
             for cookie_key in cookie_keys_set:
-                cookie = self.cache.get(cookie_key)
-                if cookie:
+                cookie = load_cookie(found_cookies.get(cookie_key))
+                if cookie is not None:
                     if self._path_ok(cookie, path):
                         cookies[cookie.key] = cookie.value
                 else:
                     expired_cookie_keys_set.add(cookie_key)
-        self.cache.set(lookup_key, cookie_keys_set.difference(expired_cookie_keys_set))
+            if expired_cookie_keys_set:
+                expired_cookie_keys_sets[lookup_key] = expired_cookie_keys_set
+        self._mark_expired(expired_cookie_keys_sets)
         return cookies
 
+    def _mark_expired(self, expired_cookie_keys_sets):
+        """
+        Remember that the cookie keys in expired_cookie_keys_sets are gone
+        from cache. They are written back later, see flush().
+        """
+        if not expired_cookie_keys_sets:
+            return
+        with self.index.lock:
+            for lookup_key, expired_cookie_keys_set in expired_cookie_keys_sets.items():
+                self._expired.setdefault(lookup_key, set()).update(expired_cookie_keys_set)
+                for cookie_key in expired_cookie_keys_set:
+                    self._lru.pop(cookie_key, None)
+                if self.snapshot is not None:
+                    self._snapshot_removed.update(expired_cookie_keys_set)
+            pending = sum(len(cookie_keys_set) for cookie_keys_set in self._expired.values())
+        if self.sweeper is None and pending >= self.max_pending_expired:
+            self.flush()
+
+    def flush(self):
+        """
+        Remove the cookie keys marked as expired from their lookup sets in
+        cache, in one bulk read and one bulk write.
+        """
+        with self.index.lock:
+            expired_cookie_keys_sets, self._expired = self._expired, {}
+        if not expired_cookie_keys_sets:
+            return
+
+        with self._locked(expired_cookie_keys_sets.keys()):
+            cookie_keys_sets = get_many(self.cache, expired_cookie_keys_sets.keys())
+            updated_cookie_keys_sets = {}
+            for lookup_key, cookie_keys_set in cookie_keys_sets.items():
+                expired_cookie_keys_set = expired_cookie_keys_sets[lookup_key]
+                if not cookie_keys_set.isdisjoint(expired_cookie_keys_set):
+                    updated_cookie_keys_sets[lookup_key] = cookie_keys_set.difference(expired_cookie_keys_set)
+            if updated_cookie_keys_sets:
+                set_many(self.cache, updated_cookie_keys_sets)
+
+    def sweep(self):
+        """
+        Check every cookie in the index against the cache, and remove the
+        ones that have expired from their lookup sets. Entries left empty or
+        stale are dropped from the index afterwards.
+        """
+        with self.index.lock:
+            indexed = [(self.get_lookup_key(kind, domain), entry,
+                        [cookie_key for cookie_keys in entry.paths.values() for cookie_key in cookie_keys])
+                       for domain, kind, entry in self.index.entries()]
+
+        cookie_keys = set()
+        for lookup_key, entry, entry_cookie_keys in indexed:
+            cookie_keys.update(entry_cookie_keys)
+        found_cookies = get_many(self.cache, list(cookie_keys)) if cookie_keys else {}
+
+        expired_cookie_keys_sets = {}
+        with self.index.lock:
+            for lookup_key, entry, entry_cookie_keys in indexed:
+                for cookie_key in entry_cookie_keys:
+                    if cookie_key not in found_cookies:
+                        entry.discard(cookie_key)
+                        expired_cookie_keys_sets.setdefault(lookup_key, set()).add(cookie_key)
+            for lookup_key, expired_cookie_keys_set in expired_cookie_keys_sets.items():
+                self._expired.setdefault(lookup_key, set()).update(expired_cookie_keys_set)
+                for cookie_key in expired_cookie_keys_set:
+                    self._lru.pop(cookie_key, None)
+                if self.snapshot is not None:
+                    self._snapshot_removed.update(expired_cookie_keys_set)
+            self.index.prune()
+        self.flush()
+
     def _path_ok(self, cookie, url):
-        if not cookie['path']:
-            return True
+        return path_matches(cookie['path'], urlparse(url).path)
+
+    def _index_cookie(self, domain, kind, cookie_key, path):
+        """
+        Add cookie_key to the index entry for domain, if the index has it
+        loaded, and forget every remembered Cookie header.
+        """
+        with self.index.lock:
+            self._forget_cookie_headers()
+            self.index.add(domain, kind, cookie_key, path)
 
-        if cookie['path'] and cookie['path'] == '/':
-            return True
-        request_path = urlparse(url).path
+    def _forget_cookie_headers(self):
+        with self.index.lock:
+            self._generation += 1
+            self._cookie_headers.clear()
 
-        if not request_path.startswith('/'):
-            request_path = '/' + request_path
+    def _touch(self, cookie_key, lookup_key):
+        """
+        Mark cookie_key as the most recently used cookie.
+        """
+        with self.index.lock:
+            self._lru.pop(cookie_key, None)
+            self._lru[cookie_key] = lookup_key
 
-        if request_path == cookie['path']:
-            return True
-        elif cookie['path'].endswith('/') and request_path.startswith(cookie['path']):
-            return True
-        elif request_path.startswith(cookie['path']) and request_path[len(cookie['path'])] == '/':
-            return True
-        else:
-            return False
+    def _least_recently_used(self, cookie_keys_set, count):
+        """
+        Return the count least recently used cookie keys in cookie_keys_set.
+        Keys this process has never used, set by another one, come first.
+        """
+        with self.index.lock:
+            cookie_keys = [cookie_key for cookie_key in cookie_keys_set if cookie_key not in self._lru]
+            if len(cookie_keys) < count:
+                cookie_keys.extend(cookie_key for cookie_key in self._lru if cookie_key in cookie_keys_set)
+        return cookie_keys[:count]
 
-    def set_domain_cookie(self, cookie):
+    def _evict_least_recently_used(self):
         """
-        Set domain cookie (i.e. cookie that has Domain attribute) in cache.
+        Evict the least recently used cookies until at most max_cookies are left.
         """
-        domain = cookie['domain']
-        if not is_domain_valid(domain):
+        evicted_cookie_keys_sets = {}
+        with self.index.lock:
+            while len(self._lru) > self.max_cookies:
+                cookie_key, lookup_key = self._lru.popitem(last=False)
+                evicted_cookie_keys_sets.setdefault(lookup_key, set()).add(cookie_key)
+                self.global_evictions += 1
+        if not evicted_cookie_keys_sets:
             return
 
-        max_age = get_max_age(cookie)
-        name = cookie.key
-        path = cookie['path']
+        delete_many(self.cache, [cookie_key for evicted_cookie_keys_set in evicted_cookie_keys_sets.values()
+                                for cookie_key in evicted_cookie_keys_set])
+        self._forget_cookie_headers()
+        self._mark_expired(evicted_cookie_keys_sets)
 
-        cookie_key = self.get_domain_cookie_key(domain, path, name)
-        lookup_key = self.get_domain_cookie_lookup_key(domain)
-        self.cache.set(cookie_key, cookie, max_age)
-
-        cookie_keys_set = self.cache.get(lookup_key) or set()
-        cookie_keys_set.add(cookie_key)
-        self.cache.set(lookup_key, cookie_keys_set)
+    @contextmanager
+    def _locked(self, lookup_keys):
+        """
+        Hold the locks of the stripes lookup_keys fall in, taken in stripe
+        order so that two callers can never wait on each other.
+        """
+        stripes = sorted(set(hash(lookup_key) % len(self._lookup_locks) for lookup_key in lookup_keys))
+        locks = [self._lookup_locks[stripe] for stripe in stripes]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
 
-    def set_origin_cookie(self, origin, cookie):
+    def _add_to_lookup_sets(self, added_cookie_keys_sets):
         """
-        Set origin cookie (i.e. cookie that does not have Domain attribute) in cache.
+        Add the cookie keys in added_cookie_keys_sets to the lookup sets under
+        their lookup keys, in one bulk read and one bulk write. Any expired
+        cookie keys still pending for those lookup sets are removed in the
+        same write.
+
+        Lookup sets are updated under a lock striped by lookup key, so
+        concurrent responses for the same domain never lose each other's
+        cookies, while responses for other domains rarely wait. A lookup set
+        that grows past max_cookies_per_domain loses its least recently used
+        cookies in the same write.
+        """
+        lookup_keys = added_cookie_keys_sets.keys()
+        with self.index.lock:
+            expired_cookie_keys_sets = dict((lookup_key, self._expired.pop(lookup_key, set()))
+                                            for lookup_key in lookup_keys)
+
+        evicted_cookie_keys_set = set()
+        with self._locked(lookup_keys):
+            cookie_keys_sets = get_many(self.cache, lookup_keys)
+            for lookup_key, added_cookie_keys_set in added_cookie_keys_sets.items():
+                cookie_keys_set = set(cookie_keys_sets.get(lookup_key) or ())   # Never change a set readers may hold
+                cookie_keys_set.difference_update(expired_cookie_keys_sets[lookup_key] - added_cookie_keys_set)
+                cookie_keys_set.update(added_cookie_keys_set)
+                cookie_keys_sets[lookup_key] = cookie_keys_set
+
+                overflow = len(cookie_keys_set) - self.max_cookies_per_domain
+                if overflow > 0:
+                    evicted_cookie_keys = self._least_recently_used(cookie_keys_set, overflow)
+                    cookie_keys_set.difference_update(evicted_cookie_keys)
+                    evicted_cookie_keys_set.update(evicted_cookie_keys)
+            set_many(self.cache, cookie_keys_sets)
+
+        if evicted_cookie_keys_set:
+            delete_many(self.cache, list(evicted_cookie_keys_set))
+            with self.index.lock:
+                for cookie_key in evicted_cookie_keys_set:
+                    self._lru.pop(cookie_key, None)
+                self.domain_evictions += len(evicted_cookie_keys_set)
+                if self.snapshot is not None:
+                    self._snapshot_removed.update(evicted_cookie_keys_set)
+
+    def _set_cookies(self, cookies):
         """
+        Set cookies in cache, where cookies is a list of tuples of (kind,
+        domain, cookie), kind being 'origin' or 'domain' and domain the origin
+        or the Domain attribute accordingly.
+        """
+        # Cookies from the snapshot must not overwrite the ones set now
+        self._load_snapshot(set(self.get_lookup_key(kind, domain) for kind, domain, cookie in cookies))
+
+        added_cookie_keys_sets = {}
+        indexed = []
+        for kind, domain, cookie in cookies:
+            path = cookie['path']
+            cookie_key = self.get_cookie_key(kind, domain, path, cookie.key)
+            lookup_key = self.get_lookup_key(kind, domain)
+            self._store_cookie(cookie_key, cookie)
+            self._touch(cookie_key, lookup_key)
+            added_cookie_keys_sets.setdefault(lookup_key, set()).add(cookie_key)
+            indexed.append((normalize_domain(domain), kind, cookie_key, path))
+        if not added_cookie_keys_sets:
+            return
+
+        self._add_to_lookup_sets(added_cookie_keys_sets)
+        for domain, kind, cookie_key, path in indexed:
+            self._index_cookie(domain, kind, cookie_key, path)
+        self._evict_least_recently_used()
+        if self.sweeper is None:
+            # Writing anyway, so write back the expired cookie keys held back too
+            self.flush()
+
+    def _store_cookie(self, cookie_key, cookie):
         max_age = get_max_age(cookie)
-        name = cookie.key
-        path = cookie['path']
+        if max_age is not None:
+            cookie.expiry = datetime.now() + timedelta(seconds=max_age)
+        self.cache.set(cookie_key, dump_cookie(cookie), max_age)
 
-        cookie_key = self.get_origin_cookie_key(origin, path, name)
-        lookup_key = self.get_origin_cookie_lookup_key(origin)
-        self.cache.set(cookie_key, cookie, max_age)
+    def set_domain_cookie(self, cookie):
+        """
+        Set domain cookie (i.e. cookie that has Domain attribute) in cache.
+        Cookies for a public suffix are ignored.
+        """
+        domain = cookie['domain']
+        if not is_domain_valid(domain) or is_public_suffix(normalize_domain(domain)):
+            return
+        self._set_cookies([('domain', domain, cookie)])
 
-        cookie_keys_set = self.cache.get(lookup_key) or set()
-        cookie_keys_set.add(cookie_key)
-        self.cache.set(lookup_key, cookie_keys_set)
\ No newline at end of file
+    def set_origin_cookie(self, origin, cookie):
+        """
+        Set origin cookie (i.e. cookie that does not have Domain attribute) in cache.
+        """
+        self._set_cookies([('origin', origin, cookie)])
@@ -23,4 +23,31 @@ def get_default_redirect_cache():
 
 def set_default_redirect_cache(cache):
     global DEFAULT_REDIRECT_CACHE
-    DEFAULT_REDIRECT_CACHE = cache
\ No newline at end of file
+    DEFAULT_REDIRECT_CACHE = cache
+
+DEFAULT_CLIENT = None
+
+def get_default_client():
+    global DEFAULT_CLIENT
+    if DEFAULT_CLIENT is None:
+        from dogbutler.client import Client
+        DEFAULT_CLIENT = Client()
+    return DEFAULT_CLIENT
+
+def set_default_client(client):
+    global DEFAULT_CLIENT
+    DEFAULT_CLIENT = client
+
+
+DEFAULT_POOL = None
+
+def get_default_pool():
+    global DEFAULT_POOL
+    if DEFAULT_POOL is None:
+        from dogbutler.pool import WorkerPool
+        DEFAULT_POOL = WorkerPool()
+    return DEFAULT_POOL
+
+def set_default_pool(pool):
+    global DEFAULT_POOL
+    DEFAULT_POOL = pool
@@ -0,0 +1,167 @@
+import sys
+from Queue import Queue
+from threading import Event, Lock, Thread
+
+
+DEFAULT_POOL_SIZE = 10      # Matches the client's per-host connection pool size
+
+
+class FutureTimeout(Exception):
+    """
+    Waiting for a Future timed out. The call itself may still finish later.
+    Not a requests exception, so it is never mistaken for a network timeout.
+    """
+
+
+class Future(object):
+    """
+    The pending result of a call submitted to a WorkerPool.
+    """
+
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return its result, or re-raise the
+        exception it raised.
+        """
+        if not self._event.wait(timeout):
+            raise FutureTimeout('Timed out waiting for result')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the call to finish and return the exception it raised, if any.
+        """
+        if not self._event.wait(timeout):
+            raise FutureTimeout('Timed out waiting for result')
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) once the call finishes, straight away if it already has.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._set_outcome(result, None)
+
+    def set_exception(self, exc_info):
+        """
+        exc_info is a tuple as returned by sys.exc_info(), so the original
+        traceback is kept when result() re-raises.
+        """
+        self._set_outcome(None, exc_info)
+
+    def _set_outcome(self, result, exc_info):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class WorkerPool(object):
+    """
+    A fixed number of long-lived worker threads that run submitted calls.
+
+    Workers are started lazily, up to size, and are reused across calls so a
+    large batch never needs more than size threads.
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self._tasks = Queue()
+        self._workers = []
+        self._lock = Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) to run on a worker and return its Future.
+        """
+        future = Future()
+        self._tasks.put((future, fn, args, kwargs))
+        self._start_worker()
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once the calls already submitted have run.
+        """
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._tasks.put(None)
+        if wait:
+            for t in workers:
+                t.join()
+
+    def _start_worker(self):
+        with self._lock:
+            if len(self._workers) >= self.size:
+                return
+            t = Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time. Callers that arrive while a call
+    for their key is in progress wait for it and share its result.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flights = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            future.set_exception(sys.exc_info())
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
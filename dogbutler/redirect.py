@@ -1,31 +1,265 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from urlparse import urlparse, urlunparse
+
 from requests.exceptions import TooManyRedirects
+from requests.sessions import DEFAULT_REDIRECT_LIMIT
+
+from dogbutler.utils.cache import get_many, get_max_age, get_expires_max_age, parse_cache_control
+
+
+PERMANENT_REDIRECT_CODES = (301, 308)       # Cacheable unless told otherwise
+TEMPORARY_REDIRECT_CODES = (302, 303, 307)  # Cacheable only with explicit freshness
+PERMANENT_REDIRECT_TIMEOUT = 24 * 60 * 60   # Seconds to keep a permanent redirect with no explicit freshness
+MAX_REDIRECT_ENTRIES = 10000                # Number of redirects to keep, least recently stored evicted first
+HOST_REWRITE_THRESHOLD = 3                  # Paths seen rewritten the same way before a host rule is used
+HOST_REWRITE_TIMEOUT = 24 * 60 * 60         # Seconds a host rule is used for after it was last seen
 
 class RedirectManager(object):
+    """
+    Remembers redirects, so later requests go straight to where they lead.
+    Permanent redirects are kept for permanent_timeout seconds unless their
+    Cache-Control or Expires header says otherwise, temporary ones only for
+    as long as those headers allow. At most max_entries are kept.
+
+    Chains are stored compressed: every URL of a chain of cacheable redirects
+    points at the last URL of the chain, until the first of them expires, so
+    following it takes one lookup for the target and one to check that the
+    target does not redirect too.
+
+    Hosts that permanently redirect every path to the same path on another
+    scheme or host (http://host/... to https://host/...) are learned once
+    host_rewrite_threshold different paths have been seen to, and new URLs
+    on them are rewritten before they are sent, for host_rewrite_timeout
+    seconds after the last sighting. A rewrite that fails is forgotten, see
+    fallback().
+    """
 
-    def __init__(self, key_prefix, cache):
+    def __init__(self, key_prefix, cache, max_redirects=DEFAULT_REDIRECT_LIMIT,
+                 permanent_timeout=PERMANENT_REDIRECT_TIMEOUT, max_entries=MAX_REDIRECT_ENTRIES,
+                 host_rewrite_threshold=HOST_REWRITE_THRESHOLD, host_rewrite_timeout=HOST_REWRITE_TIMEOUT):
         self.key_prefix = key_prefix
         self.cache = cache
+        self.max_redirects = max_redirects
+        self.permanent_timeout = permanent_timeout
+        self.max_entries = max_entries
+        self.host_rewrite_threshold = host_rewrite_threshold
+        self.host_rewrite_timeout = host_rewrite_timeout
+        self._entries = OrderedDict()   # Cache keys stored by this manager, oldest first
+        self._host_rewrites = {}        # (scheme, netloc) -> (scheme, netloc, paths seen, expires)
+        self._lock = Lock()
 
     def get_cache_key(self, url):
         return '%s.%s' % (self.key_prefix, url)
 
+    def get_timeout(self, response):
+        """
+        Return the number of seconds the redirect in response may be cached
+        for, None to cache it with no expiry, or 0 if it must not be cached.
+        """
+        if response.status_code not in PERMANENT_REDIRECT_CODES + TEMPORARY_REDIRECT_CODES:
+            return 0
+        cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+        if cache_control.no_store or cache_control.no_cache:
+            return 0
+        timeout = get_max_age(response)
+        if timeout is None:
+            timeout = get_expires_max_age(response)
+        if timeout is None:
+            return self.permanent_timeout if response.status_code in PERMANENT_REDIRECT_CODES else 0
+        return max(0, timeout)
+
+    def prefetch(self, requests):
+        """
+        Read the redirects process_request will follow for a batch of requests
+        in bulk, one read per hop for all of them instead of one per hop per
+        request. As chains are stored compressed, that is usually two reads:
+        the first hops, then the check that their targets do not redirect.
+        """
+        pending = []
+        for request in requests:
+            request._redirect_entries = {}
+            pending.append((request, request.url))
+        for i in range(self.max_redirects + 1):
+            if not pending:
+                break
+            cache_keys = [self.get_cache_key(url) for request, url in pending]
+            entries = get_many(self.cache, list(set(cache_keys)))
+            next_pending = []
+            for (request, url), cache_key in zip(pending, cache_keys):
+                entry = entries.get(cache_key)
+                request._redirect_entries[url] = entry
+                if entry is None:
+                    continue
+                redirect_to = entry[0] if isinstance(entry, tuple) else entry
+                if redirect_to not in request._redirect_entries:
+                    next_pending.append((request, redirect_to))
+            pending = next_pending
+
     def process_request(self, request):
         url = request.url
         history = []
+        expiries = []
+        prefetched = getattr(request, '_redirect_entries', None) or {}
         while True:
-            if url in history:
-                raise TooManyRedirects()
-            redirect_to = self.cache.get(self.get_cache_key(url))
-            if redirect_to is None:
+            if url in prefetched:
+                entry = prefetched[url]
+            else:
+                entry = self.cache.get(self.get_cache_key(url))
+            if entry is None:
                 break
+            # Entries stored before expiries were kept are bare URLs
+            redirect_to, expires = entry if isinstance(entry, tuple) else (entry, None)
+            history.append(url)
+            expiries.append(expires)
+            if redirect_to in history or len(history) > self.max_redirects:
+                # Forget the loop, so it does not fail every later request
+                for u in history:
+                    self._delete(u)
+                raise TooManyRedirects('Exceeded %s redirects.' % self.max_redirects)
             url = redirect_to
+
+        # Point every URL followed at the end of the chain, until the first
+        # redirect after it expires
+        expires = None
+        for i in reversed(range(len(history))):
+            expires = _earliest(expires, expiries[i])
+            if i < len(history) - 1:
+                # The last URL followed points at the end of the chain already
+                self._set(history[i], url, expires)
+
+        rewritten_url = self.get_host_rewrite(url)
+        if rewritten_url is not None:
+            request.rewritten_from = request.url
+            request.rewritten_origin = _origin(url)
+            url = rewritten_url
         request.url = url
 
+    def get_host_rewrite(self, url):
+        """
+        Return url rewritten by the learned rule for its host, or None.
+        """
+        parsed_url = urlparse(url)
+        with self._lock:
+            rule = self._host_rewrites.get(parsed_url[:2])
+        if rule is None:
+            return None
+        scheme, netloc, paths, expires = rule
+        if len(paths) < self.host_rewrite_threshold or expires <= datetime.now():
+            return None
+        return urlunparse((scheme, netloc) + parsed_url[2:])
+
+    def fallback(self, request, response=None):
+        """
+        Call with the response to a request that process_request may have
+        rewritten, or with no response if sending it failed. If the rewrite
+        turned out wrong, forget the host rule and return True: the original
+        URL, request.rewritten_from, has to be sent instead.
+
+        The rewrite is wrong if sending failed, or if the response redirected
+        back to the original origin. An error status is not enough: the
+        origin would have answered the same after its own redirect.
+        """
+        origin = getattr(request, 'rewritten_origin', None)
+        if origin is None:
+            return False
+        if response is not None \
+                and all(r.url is None or _origin(r.url) != origin for r in list(response.history) + [response]):
+            return False
+        with self._lock:
+            self._host_rewrites.pop(origin, None)
+        return True
+
+    def _learn_host_rewrite(self, url, redirect_to, timeout):
+        """
+        Count a permanent redirect from url to redirect_to towards a host
+        rule, if it keeps the path and changes only the scheme or host.
+        """
+        parsed_url = urlparse(url)
+        parsed_redirect_to = urlparse(redirect_to)
+        if parsed_url[2:] != parsed_redirect_to[2:] or parsed_url[:2] == parsed_redirect_to[:2]:
+            return
+        if timeout is None or timeout > self.host_rewrite_timeout:
+            timeout = self.host_rewrite_timeout
+        expires = datetime.now() + timedelta(seconds=timeout)
+
+        with self._lock:
+            rule = self._host_rewrites.get(parsed_url[:2])
+            if rule is None or rule[:2] != parsed_redirect_to[:2]:
+                # New, or not consistent with what was seen so far
+                paths = set()
+            else:
+                paths = rule[2]
+            if len(paths) < self.host_rewrite_threshold:
+                paths.add(parsed_url.path)
+            if len(self._host_rewrites) >= self.max_entries:
+                self._host_rewrites.clear()
+            self._host_rewrites[parsed_url[:2]] = parsed_redirect_to[:2] + (paths, expires)
+
     def process_response(self, request, response):
         if response.history:
             request.url = response.url
-            for r in response.history:
-                if r.status_code == 301:
-                    #TODO: handle case of no Location header
-                    redirect_to = r.headers.get('Location')
-                    self.cache.set(self.get_cache_key(r.url), redirect_to)
+
+            # Walk the chain backwards, carrying the furthest URL reachable by
+            # cacheable redirects alone and when the first of them expires.
+            # A redirect that cannot be cached breaks the chain.
+            now = datetime.now()
+            target = response.url
+            expires = None
+            next_url = response.url
+            for r in reversed(response.history):
+                timeout = self.get_timeout(r)
+                if timeout != 0 and r.status_code in PERMANENT_REDIRECT_CODES:
+                    self._learn_host_rewrite(r.url, next_url, timeout)
+                next_url = r.url
+                if timeout == 0:
+                    target = r.url
+                    expires = None
+                    continue
+                if timeout is not None:
+                    expires = _earliest(expires, now + timedelta(seconds=timeout))
+                if r.url != target:
+                    self._set(r.url, target, expires)
+
+    def _set(self, url, redirect_to, expires):
+        """
+        Store the redirect from url to redirect_to until expires, or with no
+        expiry if expires is None, evicting the oldest redirects past max_entries.
+        """
+        timeout = None
+        if expires is not None:
+            timeout = int((expires - datetime.now()).total_seconds())
+            if timeout <= 0:
+                return
+        cache_key = self.get_cache_key(url)
+        self.cache.set(cache_key, (redirect_to, expires), timeout)
+
+        with self._lock:
+            self._entries.pop(cache_key, None)
+            self._entries[cache_key] = True
+            evicted_cache_keys = []
+            while len(self._entries) > self.max_entries:
+                evicted_cache_keys.append(self._entries.popitem(last=False)[0])
+        for evicted_cache_key in evicted_cache_keys:
+            self.cache.delete(evicted_cache_key)
+
+    def _delete(self, url):
+        cache_key = self.get_cache_key(url)
+        self.cache.delete(cache_key)
+        with self._lock:
+            self._entries.pop(cache_key, None)
+
+
+def _origin(url):
+    return urlparse(url)[:2]
+
+def _earliest(a, b):
+    """
+    Return the earlier of two expiries, where None means never.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
@@ -0,0 +1,62 @@
+"""
+Cookie snapshots, so that a new process starts with the cookies of the last.
+"""
+import cPickle as pickle
+import sqlite3
+from threading import Lock
+import time
+
+
+class CookieSnapshot(object):
+    """
+    Cookies saved to a SQLite file. Rows are indexed by lookup key, so the
+    cookies of one domain can be loaded on their own the first time they are
+    needed, however many cookies the file holds.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS cookies ('
+                                        'cookie_key TEXT PRIMARY KEY, lookup_key TEXT NOT NULL, '
+                                        'record BLOB NOT NULL, expires REAL)')
+                self.connection.execute('CREATE INDEX IF NOT EXISTS cookies_lookup_key ON cookies (lookup_key)')
+
+    def load(self, lookup_keys):
+        """
+        Return a dictionary of lookup key -> list of (cookie_key, record,
+        expires) for the cookies under lookup_keys that have not expired.
+        expires is a timestamp, or None for a session cookie.
+        """
+        now = time.time()
+        cookies = {}
+        with self.lock:
+            for lookup_key in lookup_keys:
+                rows = self.connection.execute('SELECT cookie_key, record, expires FROM cookies '
+                                               'WHERE lookup_key = ? AND (expires IS NULL OR expires > ?)',
+                                               (lookup_key, now))
+                for cookie_key, record, expires in rows:
+                    cookies.setdefault(lookup_key, []).append((cookie_key, pickle.loads(str(record)), expires))
+        return cookies
+
+    def save(self, cookies, removed_cookie_keys=()):
+        """
+        Save cookies, a list of (cookie_key, lookup_key, record, expires), in
+        one transaction, along with deleting removed_cookie_keys and any
+        expired cookie.
+        """
+        rows = [(cookie_key, lookup_key, sqlite3.Binary(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)), expires)
+                for cookie_key, lookup_key, record, expires in cookies]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO cookies VALUES (?, ?, ?, ?)', rows)
+                self.connection.executemany('DELETE FROM cookies WHERE cookie_key = ?',
+                                            [(cookie_key,) for cookie_key in removed_cookie_keys])
+                self.connection.execute('DELETE FROM cookies WHERE expires <= ?', (time.time(),))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -3,6 +3,10 @@ from datetime import datetime
 from dummycache import cache as dummycache_cache
 from unittest import TestCase
 
+from dogbutler import cache as dogbutler_cache
+from dogbutler import cookie as dogbutler_cookie
+from dogbutler import redirect as dogbutler_redirect
+
 from ..dogbutler.defaults import get_default_cache, get_default_cookie_cache, get_default_redirect_cache
 from .dogbutler.tests.datetimestub import DatetimeStub
 
@@ -11,7 +15,7 @@ class BaseTestCase(TestCase):
 
     def setUp(self):
         super(BaseTestCase, self).setUp()
-        dummycache_cache.datetime = DatetimeStub()
+        dummycache_cache.datetime = dogbutler_cache.datetime = dogbutler_cookie.datetime = dogbutler_redirect.datetime = DatetimeStub()
         self.cache = get_default_cache()
         self.cache.clear()
         self.cookie_cache = get_default_cookie_cache()
@@ -23,5 +27,5 @@ class BaseTestCase(TestCase):
         self.redirect_cache.clear()
         self.cookie_cache.clear()
         self.cache.clear()
-        dummycache_cache.datetime = datetime
+        dummycache_cache.datetime = dogbutler_cache.datetime = dogbutler_cookie.datetime = dogbutler_redirect.datetime = datetime
         super(BaseTestCase, self).tearDown()
\ No newline at end of file
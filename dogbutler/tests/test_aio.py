@@ -0,0 +1,72 @@
+import time
+
+from mock import patch
+from requests.exceptions import ConnectionError
+from requests.models import Response
+
+from .dogbutler.tests.base import BaseTestCase
+from dogbutler import aio
+from dogbutler.pool import WorkerPool
+
+
+@patch('requests.Session.get')
+class TestAio(BaseTestCase):
+
+    def test_get(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'max-age=10',
+        }
+        mock_get.return_value = response
+
+        future = aio.get('http://www.test.com/path')
+        self.assertEqual(future.result(timeout=1).content, 'Mocked response content')
+        self.assertEqual(mock_get.call_count, 1)
+
+        # A cache hit is resolved before get returns
+        future = aio.get('http://www.test.com/path')
+        self.assertTrue(future.done())
+        self.assertEqual(future.result().content, 'Mocked response content')
+        self.assertEqual(mock_get.call_count, 1)
+
+    def test_gather_get(self, mock_get):
+        def side_effect(url, *args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.headers = {}
+            return response
+        mock_get.side_effect = side_effect
+
+        requests = [('http://www.test.com/path/%d' % i, {}) for i in range(10)]
+        responses = aio.gather_get(requests).result(timeout=1)
+        self.assertEqual([r.content for r in responses], [url for url, kwargs in requests])
+
+        self.assertEqual(aio.gather_get([]).result(timeout=1), [])
+
+    def test_gather_get_exception(self, mock_get):
+        mock_get.side_effect = ConnectionError()
+        future = aio.gather_get([('http://www.test.com/path', {})])
+        self.assertRaises(ConnectionError, future.result, 1)
+
+    def test_gather_get_coalesced(self, mock_get):
+        def side_effect(url, *args, **kwargs):
+            time.sleep(0.05)
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.headers = {
+                'Cache-Control': 'max-age=10',
+            }
+            return response
+        mock_get.side_effect = side_effect
+
+        # Concurrent misses for the same URL reach the origin once
+        pool = WorkerPool(size=10)
+        requests = [('http://www.test.com/path', {}) for _ in range(10)]
+        responses = aio.gather_get(requests, pool=pool).result(timeout=1)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertTrue(all(r is responses[0] for r in responses))
+        pool.shutdown()
@@ -1,4 +1,6 @@
 from datetime import datetime, timedelta
+from email.utils import formatdate
+import time
 
 from dummycache import cache as dummycache_cache
 from dummycache.cache import Cache
@@ -6,11 +8,12 @@ from mock import patch
 from requests.models import Response
 
 from .. import get
+from ..dogbutler.client import Client
 from ..dogbutler.defaults import set_default_cache
 from .dogbutler.tests.base import BaseTestCase
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 class TestApi(BaseTestCase):
 
     def test_get_max_age(self, mock_get):
@@ -702,10 +705,10 @@ class TestApi(BaseTestCase):
 
         #all later calls of same domain must send cookies in header
         response = get('http://www.test.com/path1')
-        mock_get.assert_called_with('http://www.test.com/path1', cookies={'name': 'value', 'name2': 'value2'})
+        mock_get.assert_called_with('http://www.test.com/path1', headers={'Cookie': 'name=value; name2=value2'})
 
         response = get('http://www.test.com/path2')
-        mock_get.assert_called_with('http://www.test.com/path2', cookies={'name': 'new_value', 'name2': 'value2', 'name3': 'value3'})
+        mock_get.assert_called_with('http://www.test.com/path2', headers={'Cookie': 'name=new_value; name2=value2; name3=value3'})
 
 #        response = get('http://www.test.com/some_other_path2/')
 #        mock_get.assert_called_with('http://www.test.com/some_other_path2/', cookies={'name2': 'value2', 'name3': 'value3', 'name': 'value'})
@@ -755,6 +758,56 @@ class TestApi(BaseTestCase):
 #        response = get('http://www.othertest.com/some_other_path/')
 #        mock_get.assert_called_with('http://www.othertest.com/some_other_path/')
 #
+    def test_cookie_on_redirect(self, mock_get):
+        redirect = Response()
+        redirect.status_code = 302
+        redirect.headers = {
+            'Set-Cookie': 's=1; max-age=20',
+            'Location': 'http://www.test.com/home',
+        }
+        redirect.url = 'http://www.test.com/login'
+
+        response = Response()
+        response.status_code = 200
+        response.headers = {}
+        response.url = 'http://www.test.com/home'
+        response.history = [redirect]
+        mock_get.return_value = response
+
+        get('http://www.test.com/login')
+
+        # The cookie set by the redirect is kept
+        get('http://www.test.com/other')
+        mock_get.assert_called_with('http://www.test.com/other', headers={'Cookie': 's=1'})
+
+    def test_cookie_from_caller(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response.headers = {
+            'Set-Cookie': 'name=value; max-age=20'
+        }
+        response.url = 'http://www.test.com/path'
+        mock_get.return_value = response
+        get('http://www.test.com/path')
+
+        # Cookies passed in are sent along with the stored ones, and win
+        get('http://www.test.com/path', cookies={'sid': '1'})
+        mock_get.assert_called_with('http://www.test.com/path', headers={'Cookie': 'name=value; sid=1'})
+        get('http://www.test.com/path', cookies={'name': 'mine'})
+        mock_get.assert_called_with('http://www.test.com/path', headers={'Cookie': 'name=mine'})
+
+        # So does a Cookie header, which is kept as it is
+        get('http://www.test.com/path', headers={'Cookie': 'a=b'})
+        mock_get.assert_called_with('http://www.test.com/path', headers={'Cookie': 'a=b; name=value'})
+
+        # Even with no stored cookies
+        get('http://www.other.com/path', cookies={'sid': '1'})
+        mock_get.assert_called_with('http://www.other.com/path', headers={'Cookie': 'sid=1'})
+
+        # The stored Cookie header is not changed by them
+        get('http://www.test.com/path')
+        mock_get.assert_called_with('http://www.test.com/path', headers={'Cookie': 'name=value'})
+
 #    def test_cookie_with_domain(self, mock_get):
 #        response0 = Response()
 #        response0.status_code = 200
@@ -811,4 +864,151 @@ class TestApi(BaseTestCase):
         get('http://www.test.com/path')
         self.assertEqual(mock_get.call_count, 3)
         get('http://www.test.com/path')
-        self.assertEqual(mock_get.call_count, 3)
\ No newline at end of file
+        self.assertEqual(mock_get.call_count, 3)
+
+    def test_get_expires(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        now = time.time()
+        response.headers = {
+            'Cache-Control': 'public',
+            'Date': formatdate(now, usegmt=True),
+            'Expires': formatdate(now + 10, usegmt=True),
+        }
+        mock_get.return_value = response
+
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 1)
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 1)
+
+        # Move time forward 10 seconds
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=10)
+
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_get_expires_only(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Expires': formatdate(time.time() + 10, usegmt=True),
+        }
+        mock_get.return_value = response
+
+        get('http://www.test.com/path')
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 1)
+
+        # Move time forward 10 seconds
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=10)
+
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_get_age(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'max-age=10',
+            'Age': '8',
+        }
+        mock_get.return_value = response
+
+        get('http://www.test.com/path')
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 1)
+
+        # Move time forward 2 seconds, the response is now 10 seconds old
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=2)
+
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_get_date_stale(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'max-age=10',
+            'Date': formatdate(time.time() - 20, usegmt=True),
+        }
+        mock_get.return_value = response
+
+        # Stale on arrival
+        get('http://www.test.com/path')
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_get_heuristic(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        now = time.time()
+        response.headers = {
+            'Date': formatdate(now, usegmt=True),
+            'Last-Modified': formatdate(now - 100, usegmt=True),
+        }
+        mock_get.return_value = response
+
+        # Fresh for a tenth of the time since it was last modified
+        get('http://www.test.com/path')
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 1)
+
+        # Move time forward 10 seconds
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=10)
+
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 2)
+        mock_get.assert_called_with('http://www.test.com/path', headers={
+            'If-Modified-Since': response.headers['Last-Modified'],
+        })
+
+    def test_get_no_store(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'no-store, max-age=10',
+        }
+        mock_get.return_value = response
+
+        get('http://www.test.com/path')
+        get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_get_s_maxage(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'max-age=1, s-maxage=10',
+        }
+        mock_get.return_value = response
+
+        client = Client(cache=Cache())
+        shared_client = Client(cache=Cache(), shared_cache=True)
+        client.get('http://www.test.com/path')
+        shared_client.get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 2)
+
+        # Move time forward 1 second
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=1)
+
+        # Only a shared cache uses s-maxage
+        client.get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 3)
+        shared_client.get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 3)
+
+        # And it does not keep private responses
+        response.headers = {
+            'Cache-Control': 'private, max-age=10',
+        }
+        shared_client.get('http://www.test.com/private')
+        shared_client.get('http://www.test.com/private')
+        self.assertEqual(mock_get.call_count, 5)
@@ -1,14 +1,41 @@
 from datetime import datetime, timedelta
+from threading import Lock
+import time
 
 from mock import patch
+from requests.exceptions import ConnectionError
 from requests.models import Response
 from dummycache import cache as dummycache_cache
+from dummycache.cache import Cache
 
 from .dogbutler.tests.base import BaseTestCase
 from dogbutler import async
+from dogbutler.client import Client
+from dogbutler.pool import WorkerPool
 
 
-@patch('requests.get')
+class BulkCache(Cache):
+
+    def __init__(self):
+        super(BulkCache, self).__init__()
+        self.gets = 0
+        self.get_manys = 0
+
+    def get(self, key, default=None):
+        self.gets += 1
+        return super(BulkCache, self).get(key, default)
+
+    def get_many(self, keys):
+        self.get_manys += 1
+        values = {}
+        for key in keys:
+            value = super(BulkCache, self).get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+
+@patch('requests.Session.get')
 class TestAsync(BaseTestCase):
 
     def test_get(self, mock_get):
@@ -77,4 +104,165 @@ class TestAsync(BaseTestCase):
         responses = async.get(requests[:1])
         self.assertEqual(mock_get.call_count, 5)
 
-        mock_get.assert_called_with('http://www.test.com/path/1', headers={'If-None-Match': '"fdcd6016cf6059cbbf418d66a51a6b0a"'})
\ No newline at end of file
+        mock_get.assert_called_with('http://www.test.com/path/1', headers={'If-None-Match': '"fdcd6016cf6059cbbf418d66a51a6b0a"'})
+
+    def test_get_hits_resolved_in_bulk(self, mock_get):
+        def side_effect(url, *args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.headers = {
+                'Cache-Control': 'max-age=10',
+            }
+            return response
+        mock_get.side_effect = side_effect
+
+        cache = BulkCache()
+        client = Client(cache=cache)
+        requests = [('http://www.test.com/path/%d' % i, {}) for i in range(10)]
+        async.get(requests, client=client)
+        self.assertEqual(mock_get.call_count, 10)
+
+        # A warm batch is served without dispatching, in three bulk reads
+        cache.gets = cache.get_manys = 0
+        pool = WorkerPool(size=4)
+        responses = async.get(requests + [('http://www.test.com/other', {})], pool=pool, client=client)
+        self.assertEqual(mock_get.call_count, 11)
+        self.assertEqual(cache.get_manys, 3)
+        self.assertEqual([r.content for r in responses[:10]], [url for url, kwargs in requests])
+        self.assertEqual(responses[10].content, 'http://www.test.com/other')
+        self.assertEqual(len(pool._workers), 1)
+        pool.shutdown()
+
+    def test_get_redirects_resolved_in_bulk(self, mock_get):
+        def side_effect(url, *args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.headers = {
+                'Cache-Control': 'max-age=10',
+            }
+            if '/old/' in url:
+                redirect = Response()
+                redirect.url = url
+                redirect.status_code = 301
+                redirect.headers = {}
+                response.history = [redirect]
+                url = url.replace('/old/', '/new/')
+            response.url = url
+            return response
+        mock_get.side_effect = side_effect
+
+        redirect_cache = BulkCache()
+        client = Client(redirect_cache=redirect_cache)
+        requests = [('http://www.test.com/old/%d' % i, {}) for i in range(5)]
+        requests += [('http://www.test.com/path/%d' % i, {}) for i in range(5)]
+        async.get(requests, client=client)
+        self.assertEqual(mock_get.call_count, 10)
+
+        # The first hops, then their targets, in one read each
+        redirect_cache.gets = redirect_cache.get_manys = 0
+        responses = async.get(requests, client=client)
+        self.assertEqual(mock_get.call_count, 10)
+        self.assertEqual(redirect_cache.get_manys, 2)
+        self.assertEqual(redirect_cache.gets, 0)
+        self.assertEqual([r.url for r in responses[:5]], ['http://www.test.com/new/%d' % i for i in range(5)])
+
+    def test_get_bounded_threads(self, mock_get):
+        # Setup mock
+        lock = Lock()
+        state = {'running': 0, 'max_running': 0}
+        def side_effect(url, *args, **kwargs):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.headers = {}
+            return response
+        mock_get.side_effect = side_effect
+
+        requests = [('http://www.test.com/path/%d' % i, {}) for i in range(20)]
+
+        pool = WorkerPool(size=4)
+        responses = async.get(requests, pool=pool)
+        self.assertEqual(mock_get.call_count, 20)
+        self.assertLessEqual(state['max_running'], 4)
+        self.assertEqual(len(pool._workers), 4)
+
+        # Responses come back in input order
+        self.assertEqual([r.content for r in responses], [url for url, kwargs in requests])
+
+        # Per-batch cap
+        state['max_running'] = 0
+        async.get(requests, pool=pool, max_in_flight=2)
+        self.assertLessEqual(state['max_running'], 2)
+        pool.shutdown()
+
+    def test_get_exception(self, mock_get):
+        mock_get.side_effect = ConnectionError()
+        self.assertRaises(ConnectionError, async.get, [('http://www.test.com/path', {})])
+
+
+    def test_iter_get(self, mock_get):
+        # Setup mock
+        def side_effect(url, *args, **kwargs):
+            if '/slow' in url:
+                time.sleep(0.05)
+            if '/error' in url:
+                raise ConnectionError()
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.headers = {}
+            return response
+        mock_get.side_effect = side_effect
+
+        requests = [
+            ('http://www.test.com/slow', {}),
+            ('http://www.test.com/path/1', {}),
+            ('http://www.test.com/error', {}),
+            ('http://www.test.com/path/2', {}),
+        ]
+
+        pool = WorkerPool(size=4)
+        results = list(async.iter_get(iter(requests), pool=pool))
+        self.assertEqual(len(results), 4)
+
+        # The slow request does not hold back the others
+        self.assertEqual(results[-1][:2], (0, 'http://www.test.com/slow'))
+        self.assertEqual(results[-1][2].content, 'http://www.test.com/slow')
+
+        results = dict((index, (url, response)) for index, url, response in results)
+        self.assertEqual(results[1][1].content, 'http://www.test.com/path/1')
+        self.assertIsInstance(results[2][1], ConnectionError)
+        self.assertEqual(results[3][1].content, 'http://www.test.com/path/2')
+        pool.shutdown()
+
+    def test_iter_get_max_in_flight(self, mock_get):
+        # Setup mock
+        lock = Lock()
+        state = {'running': 0, 'max_running': 0}
+        def side_effect(url, *args, **kwargs):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            response = Response()
+            response.status_code = 200
+            response.headers = {}
+            return response
+        mock_get.side_effect = side_effect
+
+        requests = (('http://www.test.com/path/%d' % i, {}) for i in range(10))
+        pool = WorkerPool(size=4)
+        results = list(async.iter_get(requests, pool=pool, max_in_flight=2))
+        self.assertEqual(sorted(index for index, url, response in results), range(10))
+        self.assertLessEqual(state['max_running'], 2)
+        pool.shutdown()
@@ -0,0 +1,312 @@
+from datetime import datetime, timedelta
+import time
+import urllib2
+
+from dummycache import cache as dummycache_cache
+from dummycache.cache import Cache
+from mock import patch
+from requests.cookies import create_cookie
+from requests.models import Response
+
+from dogbutler.cache import BodyStore, CacheLookup
+from dogbutler.client import Client
+from dogbutler.defaults import get_default_client, set_default_client
+from dogbutler.pool import WorkerPool
+from .dogbutler.tests.base import BaseTestCase
+
+
+class CountingCache(Cache):
+
+    def __init__(self):
+        super(CountingCache, self).__init__()
+        self.gets = 0
+
+    def get(self, key, default=None):
+        self.gets += 1
+        return super(CountingCache, self).get(key, default)
+
+
+@patch('requests.Session.get')
+class TestClient(BaseTestCase):
+
+    def test_session_reused(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {}
+        mock_get.return_value = response
+
+        client = Client()
+        session = client.session
+        client.get('http://www.test.com/path/1')
+        client.get('http://www.test.com/path/2')
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertIs(client.session, session)
+
+    def test_pool_size(self, mock_get):
+        client = Client(pool_connections=3, pool_maxsize=7)
+        for prefix in ('http://', 'https://'):
+            adapter = client.session.adapters[prefix]
+            self.assertEqual(adapter.poolmanager.connection_pool_kw['maxsize'], 7)
+            self.assertEqual(adapter.poolmanager.pools._maxsize, 3)
+
+    def test_own_cache(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'max-age=10',
+        }
+        mock_get.return_value = response
+
+        client = Client(cache=Cache())
+        client.get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 1)
+        client.get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 1)
+
+        # The default client does not share the cache
+        get_default_client().get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_call_session_keeps_cookies(self, mock_get):
+        # Cookies set on one redirect hop are sent on the next, for that call only
+        client = Client()
+        session = client._call_session()
+        cookie = create_cookie('name', 'value', domain='www.test.com')
+        session.cookies.set_cookie_if_ok(cookie, urllib2.Request('http://www.test.com/path'))
+        self.assertEqual(len(session.cookies), 1)
+        self.assertEqual(len(client.session.cookies), 0)
+        self.assertIs(session.adapters, client.session.adapters)
+
+    def test_set_default_client(self, mock_get):
+        client = Client()
+        default_client = get_default_client()
+        set_default_client(client)
+        self.assertIs(get_default_client(), client)
+        set_default_client(default_client)
+
+    def test_concurrent_misses_coalesced(self, mock_get):
+        def side_effect(url, *args, **kwargs):
+            time.sleep(0.05)
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.headers = {
+                'Cache-Control': 'max-age=10',
+            }
+            return response
+        mock_get.side_effect = side_effect
+
+        client = Client()
+        pool = WorkerPool(size=10)
+        futures = [pool.submit(client.get, 'http://www.test.com/path') for _ in range(10)]
+        responses = [future.result(timeout=1) for future in futures]
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertTrue(all(r is responses[0] for r in responses))
+
+        # Different Vary header values are not coalesced
+        futures = [pool.submit(client.get, 'http://www.test.com/other', headers={'Accept': accept})
+                   for accept in ('application/json', 'application/xml')]
+        [future.result(timeout=1) for future in futures]
+        self.assertEqual(mock_get.call_count, 3)
+        pool.shutdown()
+
+    def test_revalidation_cache_reads(self, mock_get):
+        response0 = Response()
+        response0.status_code = 200
+        response0._content = 'Mocked response content'
+        response0.headers = {
+            'Cache-Control': 'max-age=1',
+            'ETag': '"fdcd6016cf6059cbbf418d66a51a6b0a"',
+            'Last-Modified': 'Mon, 01 Oct 2012 00:00:00 GMT',
+        }
+
+        response1 = Response()
+        response1.status_code = 304
+        response1._content = ''
+        response1.headers = {}
+        mock_get.side_effect = [response0, response1]
+
+        cache = CountingCache()
+        client = Client(cache=cache)
+        client.get('http://www.test.com/path')
+
+        # Move time forward 1 second
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=1)
+
+        cache.gets = 0
+        r = client.get('http://www.test.com/path')
+        self.assertEqual(r.content, 'Mocked response content')
+
+        # Header list, validators and cached response (only because of the 304)
+        self.assertEqual(cache.gets, 3)
+
+    def test_conditional_headers_from_validators(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'max-age=1',
+            'ETag': '"fdcd6016cf6059cbbf418d66a51a6b0a"',
+            'Last-Modified': 'Mon, 01 Oct 2012 00:00:00 GMT',
+        }
+        mock_get.return_value = response
+
+        cache = Cache()
+        client = Client(cache=cache)
+        client.get('http://www.test.com/path')
+
+        # Move time forward 1 second
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=1)
+
+        # The cached response is never read to build the conditional headers
+        with patch.object(CacheLookup, 'response', None):
+            client.get('http://www.test.com/path')
+        mock_get.assert_called_with('http://www.test.com/path', headers={
+            'If-None-Match': '"fdcd6016cf6059cbbf418d66a51a6b0a"',
+            'If-Modified-Since': 'Mon, 01 Oct 2012 00:00:00 GMT',
+        })
+
+    def test_response_stored_once(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'max-age=10',
+        }
+        mock_get.return_value = response
+
+        cache = Cache()
+        client = Client(cache=cache)
+        client.get('http://www.test.com/path')
+        stored = [value for value, expires in cache._dict.values() if isinstance(value, Response)]
+        self.assertEqual(len(stored), 1)
+
+    def test_body_store(self, mock_get):
+        content = ['Shared content']
+        def side_effect(url, *args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response._content = content[0]
+            response.headers = {
+                'Cache-Control': 'max-age=1',
+                'Vary': 'Accept',
+            }
+            return response
+        mock_get.side_effect = side_effect
+
+        cache = Cache()
+        body_store = BodyStore(cache)
+        client = Client(cache=cache, body_store=body_store)
+
+        # Identical bodies are stored once
+        client.get('http://www.test.com/path?a=1')
+        client.get('http://www.test.com/path?a=2')
+        client.get('http://www.test.com/path?a=2', headers={'Accept': 'text/html'})
+        bodies = [value for key, (value, expires) in cache._dict.items() if key.startswith('body.')]
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(bodies[0]['content'], 'Shared content')
+        self.assertEqual(len(bodies[0]['refs']), 3)
+
+        # Hits are served with the body
+        r = client.get('http://www.test.com/path?a=1')
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(r.content, 'Shared content')
+
+        # Move time forward 1 second
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=1)
+
+        # Replacing a body releases the reference to the old one
+        content[0] = 'Changed content'
+        client.get('http://www.test.com/path?a=1')
+        client.get('http://www.test.com/path?a=2')
+        client.get('http://www.test.com/path?a=2', headers={'Accept': 'text/html'})
+        bodies = [value for key, (value, expires) in cache._dict.items() if key.startswith('body.')]
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(bodies[0]['content'], 'Changed content')
+
+    def test_304_without_body(self, mock_get):
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {
+            'Cache-Control': 'max-age=1',
+            'ETag': '"fdcd6016cf6059cbbf418d66a51a6b0a"',
+            'Last-Modified': 'Mon, 01 Oct 2012 00:00:00 GMT',
+        }
+        not_modified = Response()
+        not_modified.status_code = 304
+        not_modified.headers = {}
+        mock_get.side_effect = [response, not_modified, response]
+
+        body_cache = Cache()
+        client = Client(cache=Cache(), body_store=BodyStore(body_cache))
+        client.get('http://www.test.com/path')
+
+        # The body is evicted and the entry goes stale
+        body_cache._dict.clear()
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=1)
+
+        # The 304 cannot be answered from cache, so the retry is unconditional
+        r = client.get('http://www.test.com/path')
+        self.assertEqual(mock_get.call_count, 3)
+        mock_get.assert_called_with('http://www.test.com/path')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, 'Mocked response content')
+
+        # A caller's own conditional request gets its 304
+        mock_get.side_effect = [not_modified]
+        body_cache._dict.clear()
+        r = client.get('http://www.test.com/path', headers={'If-None-Match': '"other"'})
+        self.assertEqual(mock_get.call_count, 4)
+        self.assertEqual(r.status_code, 304)
+
+    def test_host_rewrite_fallback(self, mock_get):
+        def side_effect(url, *args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.headers = {}
+            if url.startswith('http://') and not url.endswith('/plain'):
+                redirect = Response()
+                redirect.url = url
+                redirect.status_code = 301
+                redirect.headers = {}
+                response.history = [redirect]
+                url = 'https://' + url[len('http://'):]
+            elif url.startswith('https://') and url.endswith('/plain'):
+                # Only served over http
+                redirect = Response()
+                redirect.url = url
+                redirect.status_code = 301
+                redirect.headers = {}
+                response.history = [redirect]
+                url = 'http://' + url[len('https://'):]
+            elif url.endswith('/missing'):
+                response.status_code = 404
+            response.url = url
+            return response
+        mock_get.side_effect = side_effect
+
+        client = Client()
+        for path in ('/a', '/b', '/c'):
+            client.get('http://www.test.com%s' % path)
+
+        # New URLs on the host go straight to https
+        r = client.get('http://www.test.com/d')
+        mock_get.assert_called_with('https://www.test.com/d')
+        self.assertEqual(r.content, 'https://www.test.com/d')
+
+        # An error from the rewritten URL is kept, as the original would give it too
+        mock_get.reset_mock()
+        r = client.get('http://www.test.com/missing')
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(r.status_code, 404)
+
+        # Until a wrong guess sends the original URL after all
+        mock_get.reset_mock()
+        r = client.get('http://www.test.com/plain')
+        self.assertEqual(mock_get.call_count, 2)
+        mock_get.assert_called_with('http://www.test.com/plain')
+        self.assertEqual(r.content, 'http://www.test.com/plain')
@@ -1,14 +1,63 @@
-from Cookie import _getdate
+from Cookie import SimpleCookie, _getdate
 from datetime import datetime, timedelta
+from threading import Thread
+import time
 
 from dummycache import cache as dummycache_cache
+from dummycache.cache import Cache
 from requests.models import Response
 
-from ..dogbutler.cookie import CookieManager
+from ..dogbutler.cookie import CookieManager, load_cookie, parse_set_cookie
 from ..dogbutler.models import Request
 from .dogbutler.tests.base import BaseTestCase
 
 
+class BulkCache(Cache):
+    """
+    A cache with get_many/set_many that records which calls are made
+    """
+
+    def __init__(self):
+        super(BulkCache, self).__init__()
+        self.calls = []
+        self.get_many_keys = []
+
+    def get(self, key, default=None):
+        self.calls.append('get')
+        return super(BulkCache, self).get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.calls.append('set')
+        return super(BulkCache, self).set(key, value, timeout)
+
+    def get_many(self, keys):
+        self.calls.append('get_many')
+        self.get_many_keys.append(list(keys))
+        values = {}
+        for key in keys:
+            value = super(BulkCache, self).get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set_many(self, values, timeout=None):
+        self.calls.append('set_many')
+        for key, value in values.items():
+            super(BulkCache, self).set(key, value, timeout)
+
+
+class SlowCache(Cache):
+    """
+    A cache that takes a moment to answer, so that unsynchronized
+    read-modify-writes would overlap
+    """
+
+    def get(self, key, default=None):
+        value = super(SlowCache, self).get(key, default)
+        time.sleep(0.001)
+        return value
+
+
 class TestCookie(BaseTestCase):
 
     def setUp(self):
@@ -46,14 +95,14 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(sweet_test_com_cookie_keys_set)
         self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key, cadbury_key]))
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = load_cookie(self.cookie_cache.get(chipsahoy_key))
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
         self.assertEqual(chipsahoy_cookie['domain'], 'sweet.test.com')
         self.assertEqual(chipsahoy_cookie['path'], '')
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = load_cookie(self.cookie_cache.get(cadbury_key))
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual(cadbury_cookie.key, 'cadbury')
         self.assertEqual(cadbury_cookie.value, 'chocolate')
@@ -65,7 +114,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(food_test_com_cookie_keys_set)
         self.assertEqual(food_test_com_cookie_keys_set, set([kfc_key]))
 
-        kfc_cookie = self.cookie_cache.get(kfc_key)
+        kfc_cookie = load_cookie(self.cookie_cache.get(kfc_key))
         self.assertIsNotNone(kfc_cookie)
         self.assertEqual(kfc_cookie.key, 'kfc')
         self.assertEqual(kfc_cookie.value, 'chicken')
@@ -77,7 +126,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(test_com_cookie_keys_set)
         self.assertEqual(test_com_cookie_keys_set, set([happymeal_key]))
 
-        happymeal_cookie = self.cookie_cache.get(happymeal_key)
+        happymeal_cookie = load_cookie(self.cookie_cache.get(happymeal_key))
         self.assertIsNotNone(happymeal_cookie)
         self.assertEqual(happymeal_cookie.key, 'happymeal')
         self.assertEqual(happymeal_cookie.value, 'meal')
@@ -130,14 +179,14 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(sweet_test_com_cookie_keys_set)
         self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key, cadbury_key]))
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = load_cookie(self.cookie_cache.get(chipsahoy_key))
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
         self.assertEqual(chipsahoy_cookie['domain'], '.sweet.test.com')
         self.assertEqual(chipsahoy_cookie['path'], '')
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = load_cookie(self.cookie_cache.get(cadbury_key))
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual(cadbury_cookie.key, 'cadbury')
         self.assertEqual(cadbury_cookie.value, 'chocolate')
@@ -149,7 +198,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(food_test_com_cookie_keys_set)
         self.assertEqual(food_test_com_cookie_keys_set, set([kfc_key]))
 
-        kfc_cookie = self.cookie_cache.get(kfc_key)
+        kfc_cookie = load_cookie(self.cookie_cache.get(kfc_key))
         self.assertIsNotNone(kfc_cookie)
         self.assertEqual(kfc_cookie.key, 'kfc')
         self.assertEqual(kfc_cookie.value, 'chicken')
@@ -161,7 +210,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(test_com_cookie_keys_set)
         self.assertEqual(test_com_cookie_keys_set, set([happymeal_key]))
 
-        happymeal_cookie = self.cookie_cache.get(happymeal_key)
+        happymeal_cookie = load_cookie(self.cookie_cache.get(happymeal_key))
         self.assertIsNotNone(happymeal_cookie)
         self.assertEqual(happymeal_cookie.key, 'happymeal')
         self.assertEqual(happymeal_cookie.value, 'meal')
@@ -227,6 +276,7 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'cadbury': 'chocolate', 'happymeal': 'meal'})
+        self.cookie_manager.flush()    # Expired cookie keys are written back later
         cookie_keys_set = self.cookie_cache.get(lookup_key)
         self.assertEqual(cookie_keys_set, set([cadbury_key, happymeal_key]))
 
@@ -236,6 +286,7 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'happymeal': 'meal'})
+        self.cookie_manager.flush()    # Expired cookie keys are written back later
         cookie_keys_set = self.cookie_cache.get(lookup_key)
         self.assertEqual(cookie_keys_set, set([happymeal_key]))
 
@@ -271,28 +322,28 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(sweet_test_com_cookie_keys_set)
         self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key, cadbury_key, kfc_key, happymeal_key]))
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = load_cookie(self.cookie_cache.get(chipsahoy_key))
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
         self.assertEqual(chipsahoy_cookie['domain'], 'sweet.test.com')
         self.assertEqual(chipsahoy_cookie['path'], '/')
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = load_cookie(self.cookie_cache.get(cadbury_key))
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual(cadbury_cookie.key, 'cadbury')
         self.assertEqual(cadbury_cookie.value, 'chocolate')
         self.assertEqual(cadbury_cookie['domain'], 'sweet.test.com')
         self.assertEqual(cadbury_cookie['path'], '/help')
 
-        kfc_cookie = self.cookie_cache.get(kfc_key)
+        kfc_cookie = load_cookie(self.cookie_cache.get(kfc_key))
         self.assertIsNotNone(kfc_cookie)
         self.assertEqual(kfc_cookie.key, 'kfc')
         self.assertEqual(kfc_cookie.value, 'chicken')
         self.assertEqual(kfc_cookie['domain'], 'sweet.test.com')
         self.assertEqual(kfc_cookie['path'], '/help/me')
 
-        happymeal_cookie = self.cookie_cache.get(happymeal_key)
+        happymeal_cookie = load_cookie(self.cookie_cache.get(happymeal_key))
         self.assertIsNotNone(happymeal_cookie)
         self.assertEqual(happymeal_cookie.key, 'happymeal')
         self.assertEqual(happymeal_cookie.value, 'meal')
@@ -354,7 +405,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(sweet_test_com_cookie_keys_set)
         self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key]))
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = load_cookie(self.cookie_cache.get(chipsahoy_key))
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
@@ -366,7 +417,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(pop_test_com_cookie_keys_set)
         self.assertEqual(pop_test_com_cookie_keys_set, set([coke_key]))
 
-        coke_cookie = self.cookie_cache.get(coke_key)
+        coke_cookie = load_cookie(self.cookie_cache.get(coke_key))
         self.assertIsNotNone(coke_cookie)
         self.assertEqual(coke_cookie.key, 'coke')
         self.assertEqual(coke_cookie.value, 'soda')
@@ -378,7 +429,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(test_com_cookie_keys_set)
         self.assertEqual(test_com_cookie_keys_set, set([squeeze_key]))
 
-        squeeze_cookie = self.cookie_cache.get(squeeze_key)
+        squeeze_cookie = load_cookie(self.cookie_cache.get(squeeze_key))
         self.assertIsNotNone(squeeze_cookie)
         self.assertEqual(squeeze_cookie.key, 'squeeze')
         self.assertEqual(squeeze_cookie.value, 'juice')
@@ -440,6 +491,7 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'coke': 'soda', 'kitkat': 'chocolate'})
+        self.cookie_manager.flush()    # Expired cookie keys are written back later
         cookie_keys_set = self.cookie_cache.get(lookup_key)
         self.assertEqual(cookie_keys_set, set([coke_key, kitkat_key]))
 
@@ -449,6 +501,7 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'kitkat': 'chocolate'})
+        self.cookie_manager.flush()    # Expired cookie keys are written back later
         cookie_keys_set = self.cookie_cache.get(lookup_key)
         self.assertEqual(cookie_keys_set, set([kitkat_key]))
 
@@ -494,14 +547,14 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(sweet_test_com_cookie_keys_set)
         self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key, cadbury_key]))
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = load_cookie(self.cookie_cache.get(chipsahoy_key))
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
         self.assertEqual(chipsahoy_cookie['domain'], 'sweet.test.com')
         self.assertEqual(chipsahoy_cookie['path'], '')
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = load_cookie(self.cookie_cache.get(cadbury_key))
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual(cadbury_cookie.key, 'cadbury')
         self.assertEqual(cadbury_cookie.value, 'chocolate')
@@ -513,7 +566,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(food_test_com_cookie_keys_set)
         self.assertEqual(food_test_com_cookie_keys_set, set([kfc_key]))
 
-        kfc_cookie = self.cookie_cache.get(kfc_key)
+        kfc_cookie = load_cookie(self.cookie_cache.get(kfc_key))
         self.assertIsNotNone(kfc_cookie)
         self.assertEqual(kfc_cookie.key, 'kfc')
         self.assertEqual(kfc_cookie.value, 'chicken')
@@ -525,7 +578,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(www_test_com_origin_cookie_keys_set)
         self.assertEqual(www_test_com_origin_cookie_keys_set, set([coke_key]))
 
-        coke_cookie = self.cookie_cache.get(coke_key)
+        coke_cookie = load_cookie(self.cookie_cache.get(coke_key))
         self.assertIsNotNone(coke_cookie)
         self.assertEqual(coke_cookie.key, 'coke')
         self.assertEqual(coke_cookie.value, 'soda')
@@ -537,7 +590,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(test_com_origin_cookie_keys_set)
         self.assertEqual(test_com_origin_cookie_keys_set, set([happymeal_key]))
 
-        squeeze_cookie = self.cookie_cache.get(happymeal_key)
+        squeeze_cookie = load_cookie(self.cookie_cache.get(happymeal_key))
         self.assertIsNotNone(squeeze_cookie)
         self.assertEqual(squeeze_cookie.key, 'happymeal')
         self.assertEqual(squeeze_cookie.value, 'meal')
@@ -548,7 +601,7 @@ class TestCookie(BaseTestCase):
         self.assertIsNotNone(test_com_origin_cookie_keys_set)
         self.assertEqual(test_com_origin_cookie_keys_set, set([squeeze_key]))
 
-        squeeze_cookie = self.cookie_cache.get(squeeze_key)
+        squeeze_cookie = load_cookie(self.cookie_cache.get(squeeze_key))
         self.assertIsNotNone(squeeze_cookie)
         self.assertEqual(squeeze_cookie.key, 'squeeze')
         self.assertEqual(squeeze_cookie.value, 'juice')
@@ -576,8 +629,8 @@ class TestCookie(BaseTestCase):
 
     def test_cookie_no_dashed_expires_date_format(self):
         """
-        SimpleCookie.loads recognize only dashed date style format, this is to make sure that if server send a new date
-        format
+        Make sure that both dashed and spaced Expires dates are understood, and that a date that
+        cannot be parsed is ignored
         """
 
         # Cookie cache keys for convenience
@@ -588,8 +641,8 @@ class TestCookie(BaseTestCase):
         # Prepare test response
         response = Response()
         response.headers = {
-            'Set-Cookie': 'chipsahoy=cookie; expires=Thu, 12 Jan 2013 12:34:22 GMT;, '
-                          'cadbury=chocolate; Expires=Wed, 20-Feb-2014 08:23:55 GMT;, '
+            'Set-Cookie': 'chipsahoy=cookie; expires=Wed, 12 Jan 2033 12:34:22 GMT;, '
+                          'cadbury=chocolate; Expires=Mon, 20-Feb-2034 08:23:55 GMT;, '
                           'coke=soda; Expires = Fri, 02 Jan 2021 GMT;'
         }
         response.url = 'http://www.test.com/'
@@ -598,21 +651,464 @@ class TestCookie(BaseTestCase):
         ##### Process response cookie #####
         self.cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = load_cookie(self.cookie_cache.get(chipsahoy_key))
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual('chipsahoy', chipsahoy_cookie.key)
         self.assertEqual('cookie', chipsahoy_cookie.value)
-        self.assertEqual('Thu, 12-Jan-2013 12:34:22 GMT', chipsahoy_cookie['expires'])
+        self.assertEqual('Wed, 12-Jan-2033 12:34:22 GMT', chipsahoy_cookie['expires'])
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = load_cookie(self.cookie_cache.get(cadbury_key))
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual('cadbury', cadbury_cookie.key)
         self.assertEqual('chocolate', cadbury_cookie.value)
-        self.assertEqual('Wed, 20-Feb-2014 08:23:55 GMT', cadbury_cookie['expires'])
+        self.assertEqual('Mon, 20-Feb-2034 08:23:55 GMT', cadbury_cookie['expires'])
 
         # cookie with wrong expires format won't get stored!
-        coke_cookie = self.cookie_cache.get(coke_key)
+        coke_cookie = load_cookie(self.cookie_cache.get(coke_key))
         self.assertIsNotNone(coke_cookie)
         self.assertEqual('coke', coke_cookie.key)
         self.assertEqual('soda', coke_cookie.value)
         self.assertEqual('', coke_cookie['expires'])
+
+
+    def test_bulk_cache_calls(self):
+        """
+        Test that a cache with get_many/set_many takes a fixed number of calls per request
+        """
+        cache = BulkCache()
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=cache)
+
+        # Prepare test response
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'chipsahoy=cookie; Domain=sweet.test.com; Max-Age=3;, ' +
+                          'happymeal=meal; Domain=test.com;, ' +
+                          'coke=soda;'
+        }
+        response.url = 'http://www.sweet.test.com/path'
+        cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+
+        cache.calls = []
+        request = Request('http://www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'chipsahoy': 'cookie', 'happymeal': 'meal', 'coke': 'soda'})
+        self.assertEqual(cache.calls, ['get_many', 'get_many'])
+
+        # 3 seconds pass by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
+
+        # Reads never write, not even when a cookie has expired
+        cache.calls = []
+        request = Request('http://www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'happymeal': 'meal', 'coke': 'soda'})
+        self.assertEqual(cache.calls, ['get_many'])
+        chipsahoy_key = cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'chipsahoy')
+        lookup_key = cookie_manager.get_domain_cookie_lookup_key('sweet.test.com')
+        self.assertIn(chipsahoy_key, cache.get(lookup_key))
+
+        # The expired cookie key is written back with the next cookie set
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'pepsi=soda;'
+        }
+        response.url = 'http://www.sweet.test.com/path'
+        cookie_manager.process_response(None, response)
+        self.assertNotIn(chipsahoy_key, cache.get(lookup_key))
+
+
+    def test_sweeper(self):
+        """
+        Test that with a sweeper, reads never write and expired cookies are swept later
+        """
+        cache = BulkCache()
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=cache, sweep_interval=3600)
+        lookup_key = cookie_manager.get_domain_cookie_lookup_key('sweet.test.com')
+        chipsahoy_key = cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'chipsahoy')
+        cadbury_key = cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'cadbury')
+
+        # Prepare test response
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'chipsahoy=cookie; Domain=sweet.test.com; Max-Age=3;, ' +
+                          'cadbury=chocolate; Domain=sweet.test.com; Max-Age=6;'
+        }
+        response.url = 'http://www.sweet.test.com/path'
+        cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+
+        request = Request('http://www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'chipsahoy': 'cookie', 'cadbury': 'chocolate'})
+
+        # 3 seconds pass by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
+
+        cache.calls = []
+        request = Request('http://www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'cadbury': 'chocolate'})
+        self.assertEqual(cache.calls, ['get_many'])
+        self.assertEqual(cache.get(lookup_key), set([chipsahoy_key, cadbury_key]))
+
+        # 3 more seconds pass by, and the sweeper runs
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=6)
+
+        cookie_manager.sweep()
+        self.assertEqual(cache.get(lookup_key), set())
+
+        cookie_manager.close()
+        self.assertIsNone(cookie_manager.sweeper)
+
+
+    def test_cookie_header_memo(self):
+        """
+        Test that the Cookie header is remembered until a cookie is set or expires
+        """
+        cache = BulkCache()
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=cache)
+
+        # Prepare test response
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'chipsahoy=cookie; Domain=sweet.test.com; Max-Age=3;, ' +
+                          'coke=soda;'
+        }
+        response.url = 'http://www.sweet.test.com/path'
+        cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+
+        request = Request('http://www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.headers['Cookie'], 'chipsahoy=cookie; coke=soda')
+
+        # Repeat requests do not touch the cache
+        cache.calls = []
+        request = Request('http://www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'chipsahoy': 'cookie', 'coke': 'soda'})
+        self.assertEqual(request.headers['Cookie'], 'chipsahoy=cookie; coke=soda')
+        self.assertEqual(cache.calls, [])
+
+        # Setting a cookie is seen straight away
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'pepsi=soda;'
+        }
+        response.url = 'http://www.sweet.test.com/path'
+        cookie_manager.process_response(None, response)
+
+        request = Request('http://www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.headers['Cookie'], 'chipsahoy=cookie; coke=soda; pepsi=soda')
+
+        # 3 seconds pass by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
+
+        request = Request('http://www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.headers['Cookie'], 'coke=soda; pepsi=soda')
+
+
+    def test_concurrent_set_cookie(self):
+        """
+        Test that cookies set by concurrent responses for the same domain are all kept
+        """
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=SlowCache())
+
+        def process_response(i):
+            response = Response()
+            response.headers = {
+                'Set-Cookie': 'cookie%d=value%d; Domain=test.com;, origin%d=value%d;' % (i, i, i, i)
+            }
+            response.url = 'http://www.test.com/path'
+            cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+
+        threads = [Thread(target=process_response, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        cookies = cookie_manager.get_cookies('http://www.test.com/path')
+        self.assertEqual(len(cookies), 40)
+        self.assertEqual(cookies['cookie7'], 'value7')
+        self.assertEqual(cookies['origin13'], 'value13')
+
+
+    def test_concurrent_get_and_set_cookie(self):
+        """
+        Test that reading cookies while other threads set them does not fail
+        """
+        cookie_manager = self.cookie_manager
+        errors = []
+
+        def process_response(i):
+            for j in range(8):
+                response = Response()
+                response.headers = {
+                    'Set-Cookie': 'cookie%d_%d=value; Domain=test.com;, origin%d_%d=value;' % (i, j, i, j)
+                }
+                response.url = 'http://www.test.com/path'
+                cookie_manager.process_response(None, response)
+
+        def get_cookies():
+            try:
+                for j in range(200):
+                    cookie_manager.get_domain_cookies('test.com', '/path')
+                    cookie_manager.get_origin_cookies('www.test.com', '/path')
+            except Exception, e:
+                errors.append(e)
+
+        threads = [Thread(target=process_response, args=(i,)) for i in range(5)]
+        threads += [Thread(target=get_cookies) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cookie_manager.get_domain_cookies('test.com', '/path')), 40)
+        self.assertEqual(len(cookie_manager.get_origin_cookies('www.test.com', '/path')), 40)
+
+
+    def test_cookie_limits(self):
+        """
+        Test that past the per domain and total limits, the least recently used cookies are evicted
+        """
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=self.cookie_cache,
+                                       max_cookies_per_domain=3, max_cookies=5)
+
+        def set_cookie(url, set_cookie_header):
+            response = Response()
+            response.headers = {'Set-Cookie': set_cookie_header}
+            response.url = url
+            cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+
+        set_cookie('http://www.test.com/path', 'chipsahoy=cookie; Domain=test.com;')
+        set_cookie('http://www.test.com/path', 'cadbury=chocolate; Domain=test.com; Path=/sweet;')
+        set_cookie('http://www.test.com/path', 'kfc=chicken; Domain=test.com;')
+
+        # Using chipsahoy and kfc leaves cadbury the least recently used
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/path'), {'chipsahoy': 'cookie', 'kfc': 'chicken'})
+        set_cookie('http://www.test.com/path', 'happymeal=meal; Domain=test.com;')
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/sweet'),
+                         {'chipsahoy': 'cookie', 'kfc': 'chicken', 'happymeal': 'meal'})
+        self.assertIsNone(self.cookie_cache.get(cookie_manager.get_domain_cookie_key('test.com', '/sweet', 'cadbury')))
+        self.assertEqual(len(self.cookie_cache.get(cookie_manager.get_domain_cookie_lookup_key('test.com'))), 3)
+        self.assertEqual(cookie_manager.domain_evictions, 1)
+        self.assertEqual(cookie_manager.global_evictions, 0)
+
+        # A cookie on a third domain takes the total past 5, evicting the least recently used one
+        set_cookie('http://www.food.com/path', 'coke=soda; Domain=food.com;, pepsi=soda; Domain=food.com;')
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/'),
+                         {'chipsahoy': 'cookie', 'kfc': 'chicken', 'happymeal': 'meal'})
+        set_cookie('http://www.drink.com/path', 'sprite=soda; Domain=drink.com;')
+        self.assertEqual(cookie_manager.get_cookies('http://www.food.com/'), {'pepsi': 'soda'})
+        self.assertEqual(self.cookie_cache.get(cookie_manager.get_domain_cookie_lookup_key('food.com')),
+                         set([cookie_manager.get_domain_cookie_key('food.com', '', 'pepsi')]))
+        self.assertEqual(cookie_manager.domain_evictions, 1)
+        self.assertEqual(cookie_manager.global_evictions, 1)
+
+
+    def test_cookie_stored_as_tuple(self):
+        """
+        Test that cookies are stored as plain tuples and load back the same
+        """
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'chipsahoy=cookie; Domain=sweet.test.com; Path=/help; Max-Age=60; Secure; HttpOnly'
+        }
+        response.url = 'http://www.sweet.test.com/path'
+        self.cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+
+        record = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_key('sweet.test.com', '/help', 'chipsahoy'))
+        self.assertIs(type(record), tuple)
+        chipsahoy_cookie = load_cookie(record)
+        self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
+        self.assertEqual(chipsahoy_cookie.value, 'cookie')
+        self.assertEqual(chipsahoy_cookie['domain'], 'sweet.test.com')
+        self.assertEqual(chipsahoy_cookie['path'], '/help')
+        self.assertEqual(chipsahoy_cookie['max-age'], '60')
+        self.assertTrue(chipsahoy_cookie['secure'])
+        self.assertTrue(chipsahoy_cookie['httponly'])
+        self.assertIsNotNone(chipsahoy_cookie.expiry)
+        self.assertIsNone(load_cookie(None))
+
+    def test_load_morsel(self):
+        """
+        Test that Cookie.Morsels stored by earlier versions load with their attributes, and other values as missing
+        """
+        cookie = SimpleCookie()
+        cookie.load('sid=abc; Domain=sweet.test.com; Path=/help; Max-Age=60; Secure; Expires=Sun, 06-Nov-1994 08:49:37 GMT')
+        sid_cookie = load_cookie(cookie['sid'])
+        self.assertEqual(sid_cookie.key, 'sid')
+        self.assertEqual(sid_cookie.value, 'abc')
+        self.assertEqual(sid_cookie['domain'], 'sweet.test.com')
+        self.assertEqual(sid_cookie['path'], '/help')
+        self.assertEqual(sid_cookie.max_age, 60)
+        self.assertEqual(sid_cookie.expires, 784111777)
+        self.assertTrue(sid_cookie['secure'])
+        self.assertFalse(sid_cookie['httponly'])
+
+        self.assertIsNone(load_cookie({'sid': 'abc'}))
+        self.assertIsNone(load_cookie('sid=abc'))
+
+
+    def test_public_suffix_cookies(self):
+        """
+        Test that cookies are not set on public suffixes, nor looked up above the registrable domain
+        """
+        cache = BulkCache()
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=cache)
+
+        # Prepare test response
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'tracker=everyone; Domain=.com;, ' +
+                          'uktracker=everyone; Domain=co.uk;, ' +
+                          'chipsahoy=cookie; Domain=sweet.test.co.uk;'
+        }
+        response.url = 'http://www.sweet.test.co.uk/path'
+        cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+        self.assertIsNone(cache.get(cookie_manager.get_domain_cookie_lookup_key('com')))
+        self.assertIsNone(cache.get(cookie_manager.get_domain_cookie_lookup_key('co.uk')))
+
+        cache.calls = []
+        cache.get_many_keys = []
+        cookies = cookie_manager.get_cookies('http://www.sweet.test.co.uk/help')
+        self.assertEqual(cookies, {'chipsahoy': 'cookie'})
+
+        # The lookup sets above test.co.uk are never read
+        lookup_keys = cache.get_many_keys[0]
+        self.assertIn(cookie_manager.get_domain_cookie_lookup_key('test.co.uk'), lookup_keys)
+        self.assertNotIn(cookie_manager.get_domain_cookie_lookup_key('co.uk'), lookup_keys)
+        self.assertNotIn(cookie_manager.get_domain_cookie_lookup_key('uk'), lookup_keys)
+
+        # A public suffix host may still set a host-only cookie on itself
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'pages=site; Domain=github.io;'
+        }
+        response.url = 'http://github.io/path'
+        cookie_manager.process_response(None, response)
+        self.assertEqual(cookie_manager.get_cookies('http://github.io/'), {'pages': 'site'})
+        self.assertEqual(cookie_manager.get_cookies('http://www.github.io/'), {})
+
+
+    def test_index_walk(self):
+        """
+        Test that once indexed, cookies for a long hostname are found without probing every suffix
+        """
+        cache = BulkCache()
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=cache)
+
+        # Prepare test response
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'chipsahoy=cookie; Domain=sweet.test.com; Path=/help;, ' +
+                          'happymeal=meal; Domain=test.com;, ' +
+                          'coke=soda;'
+        }
+        response.url = 'http://a.b.c.www.sweet.test.com/path'
+        cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+
+        request = Request('http://a.b.c.www.sweet.test.com/help')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'chipsahoy': 'cookie', 'happymeal': 'meal', 'coke': 'soda'})
+
+        # Only the matching cookies are read, in one call
+        cache.calls = []
+        request = Request('http://a.b.c.www.sweet.test.com/')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'happymeal': 'meal', 'coke': 'soda'})
+        self.assertEqual(cache.calls, ['get_many'])
+
+        # Cookies set after indexing are found too
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'kitkat=chocolate; Domain=www.sweet.test.com;'
+        }
+        response.url = 'http://a.b.c.www.sweet.test.com/path'
+        cookie_manager.process_response(None, response)
+
+        cache.calls = []
+        request = Request('http://a.b.c.www.sweet.test.com/')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'happymeal': 'meal', 'coke': 'soda', 'kitkat': 'chocolate'})
+        self.assertEqual(cache.calls, ['get_many'])
+
+
+    def test_index_bounded(self):
+        """
+        Test that hosts without cookies leave nothing in the index, and that it keeps at most max entries
+        """
+        cache = BulkCache()
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=cache, index_max_entries=8)
+
+        for i in range(100):
+            cookie_manager.get_cookies('http://www.host%d.test.com/' % i)
+        self.assertEqual(cookie_manager.index.size, 0)
+        self.assertEqual(cookie_manager.index.root.children, {})
+        self.assertLessEqual(len(cookie_manager.index.empty), 8)
+
+        for i in range(20):
+            response = Response()
+            response.headers = {
+                'Set-Cookie': 'coke=soda%d;' % i
+            }
+            response.url = 'http://www.host%d.test.com/path' % i
+            cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+            self.assertEqual(cookie_manager.get_cookies('http://www.host%d.test.com/' % i), {'coke': 'soda%d' % i})
+        self.assertLessEqual(cookie_manager.index.size, 8)
+
+        # Dropped entries are read again from the cache
+        self.assertEqual(cookie_manager.get_cookies('http://www.host0.test.com/'), {'coke': 'soda0'})
+
+        # Entries left empty are dropped with their nodes
+        for i in range(20):
+            cache.delete(cookie_manager.get_origin_cookie_key('www.host%d.test.com' % i, '', 'coke'))
+        cookie_manager.sweep()
+        self.assertEqual(cookie_manager.index.size, 0)
+        self.assertEqual(cookie_manager.index.root.children, {})
+
+        # Entries loaded together are all used, even past max entries
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=Cache(), index_max_entries=1)
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'coke=soda;, pepsi=soda; Domain=test.com;'
+        }
+        response.url = 'http://www.test.com/path'
+        cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/'), {'coke': 'soda', 'pepsi': 'soda'})
+        self.assertEqual(cookie_manager.index.size, 1)
+
+
+    def test_parse_set_cookie(self):
+        """
+        Test parsing Set-Cookie headers that SimpleCookie used to reject or mangle
+        """
+        cookies = parse_set_cookie(
+            'session=a1b2c3; Path=/; Secure; HttpOnly, '
+            'pref=lang=en; expires=Sunday, 06-Nov-94 08:49:37 GMT, '
+            'old=1; expires=Sun Nov  6 08:49:37 1994, '
+            'list=a,b; Max-Age=60; Path=relative'
+        )
+        self.assertEqual([c.key for c in cookies], ['session', 'pref', 'old', 'list'])
+
+        session, pref, old, lst = cookies
+        self.assertEqual(session.value, 'a1b2c3')
+        self.assertEqual(session['path'], '/')
+        self.assertTrue(session.secure)
+        self.assertTrue(session.httponly)
+
+        self.assertEqual(pref.value, 'lang=en')
+        self.assertEqual(pref['expires'], 'Sun, 06-Nov-1994 08:49:37 GMT')
+        self.assertEqual(old['expires'], 'Sun, 06-Nov-1994 08:49:37 GMT')
+
+        self.assertEqual(lst.value, 'a,b')
+        self.assertEqual(lst.max_age, 60)
+        self.assertEqual(lst['max-age'], '60')
+        self.assertEqual(lst['path'], '')
+
+        # Cookies without a name or a value are ignored
+        self.assertEqual(parse_set_cookie('=nameless; Path=/'), [])
+        self.assertEqual(parse_set_cookie('novalue; Path=/'), [])
@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+from requests.models import Response
+
+from dogbutler.utils.cache import get_freshness_lifetime, parse_cache_control
+from dogbutler.utils.http import parse_http_date, parse_http_date_safe, parse_cookie_date
+
+
+class TestHttpDate(TestCase):
+
+    def test_parse_http_date(self):
+        # IMF-fixdate, RFC 850 and asctime all give the same timestamp
+        self.assertEqual(parse_http_date('Sun, 06 Nov 1994 08:49:37 GMT'), 784111777)
+        self.assertEqual(parse_http_date('Sunday, 06-Nov-94 08:49:37 GMT'), 784111777)
+        self.assertEqual(parse_http_date('Sun Nov  6 08:49:37 1994'), 784111777)
+        self.assertRaises(ValueError, parse_http_date, 'Sun, 06 Nov 1994')
+
+    def test_parse_http_date_safe(self):
+        self.assertEqual(parse_http_date_safe('Sun, 06 Nov 1994 08:49:37 GMT'), 784111777)
+        self.assertEqual(parse_http_date_safe('Sun, 06 Nov 1994 08:49:37 GMT'), 784111777)
+        self.assertIsNone(parse_http_date_safe('0'))
+
+    def test_parse_cookie_date(self):
+        self.assertEqual(parse_cookie_date('Sun, 06-Nov-1994 08:49:37 GMT'), 784111777)
+        self.assertEqual(parse_cookie_date('Sun, 06 Nov 1994 08:49:37 GMT'), 784111777)
+        self.assertEqual(parse_cookie_date('Sunday, 06-Nov-94 08:49:37 GMT'), 784111777)
+        self.assertIsNone(parse_cookie_date('Fri, 02 Jan 2021 GMT'))
+
+
+class TestFreshness(TestCase):
+
+    def test_parse_cache_control(self):
+        cache_control = parse_cache_control('public, Max-Age=10, s-maxage="20", no-cache="Set-Cookie"')
+        self.assertEqual(cache_control.max_age, 10)
+        self.assertEqual(cache_control.s_maxage, 20)
+        self.assertTrue(cache_control.no_cache)
+        self.assertFalse(cache_control.no_store)
+        self.assertFalse(cache_control.must_revalidate)
+        self.assertIsNone(parse_cache_control('max-age=ten').max_age)
+        self.assertIsNone(parse_cache_control(None).max_age)
+
+        # Identical headers are parsed once
+        self.assertIs(parse_cache_control('max-age=10'), parse_cache_control('max-age=10'))
+
+    def test_get_freshness_lifetime(self):
+        response = Response()
+        response.status_code = 200
+        response.headers = {
+            'Cache-Control': 'max-age=10, s-maxage=20',
+            'Date': 'Sun, 06 Nov 1994 08:49:37 GMT',
+            'Expires': 'Sun, 06 Nov 1994 08:50:07 GMT',
+            'Last-Modified': 'Sun, 06 Nov 1994 08:33:57 GMT',
+        }
+        self.assertEqual(get_freshness_lifetime(response, shared=True), 20)
+        self.assertEqual(get_freshness_lifetime(response), 10)
+        response.headers['Cache-Control'] = 'public'
+        self.assertEqual(get_freshness_lifetime(response), 30)
+        del response.headers['Expires']
+        self.assertEqual(get_freshness_lifetime(response), 94)
+
+        # No heuristic freshness for status codes that do not allow it
+        response.status_code = 201
+        self.assertIsNone(get_freshness_lifetime(response))
@@ -0,0 +1,64 @@
+from threading import Event
+import time
+from unittest import TestCase
+
+from requests.exceptions import RequestException
+
+from dogbutler.pool import FutureTimeout, SingleFlight, WorkerPool
+
+
+class TestWorkerPool(TestCase):
+
+    def setUp(self):
+        super(TestWorkerPool, self).setUp()
+        self.pool = WorkerPool(size=2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        super(TestWorkerPool, self).tearDown()
+
+    def test_submit(self):
+        futures = [self.pool.submit(lambda x: x * 2, i) for i in range(10)]
+        self.assertEqual([f.result(timeout=1) for f in futures], range(0, 20, 2))
+        self.assertEqual(len(self.pool._workers), 2)
+
+    def test_exception(self):
+        def fail():
+            raise ValueError('failed')
+        future = self.pool.submit(fail)
+        self.assertRaises(ValueError, future.result, 1)
+        self.assertIsInstance(future.exception(timeout=1), ValueError)
+
+    def test_timeout(self):
+        event = Event()
+        future = self.pool.submit(event.wait)
+        self.assertRaises(FutureTimeout, future.result, 0.01)
+        self.assertFalse(issubclass(FutureTimeout, RequestException))
+        event.set()
+        future.result(timeout=1)
+
+    def test_done_callback(self):
+        done = []
+        future = self.pool.submit(lambda: 'result')
+        future.result(timeout=1)
+        future.add_done_callback(lambda f: done.append(f.result()))
+        self.assertEqual(done, ['result'])
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        event = Event()
+        calls = []
+        def fetch():
+            calls.append(1)
+            event.wait(1)
+            return 'result'
+
+        futures = [self.pool.submit(flights.do, 'key', fetch) for _ in range(2)]
+        time.sleep(0.01)
+        event.set()
+        self.assertEqual([f.result(timeout=1) for f in futures], ['result', 'result'])
+        self.assertEqual(len(calls), 1)
+
+        # Once the call has finished, the next one runs again
+        self.assertEqual(flights.do('key', fetch), 'result')
+        self.assertEqual(len(calls), 2)
@@ -0,0 +1,30 @@
+from unittest import TestCase
+
+from dogbutler.utils.publicsuffix import get_public_suffix, get_registrable_domain, is_public_suffix
+
+
+class TestPublicSuffix(TestCase):
+
+    def test_get_public_suffix(self):
+        self.assertEqual(get_public_suffix('www.test.com'), 'com')
+        self.assertEqual(get_public_suffix('www.test.co.uk'), 'co.uk')
+        self.assertEqual(get_public_suffix('WWW.Test.Co.UK.'), 'co.uk')
+        # Unlisted TLDs
+        self.assertEqual(get_public_suffix('www.test.unlisted'), 'unlisted')
+        # Wildcard and exception rules
+        self.assertEqual(get_public_suffix('www.test.ck'), 'test.ck')
+        self.assertEqual(get_public_suffix('www.ck'), 'ck')
+        # Internationalized rules are matched in punycode
+        self.assertEqual(get_public_suffix('www.example.xn--fiqs8s'), 'xn--fiqs8s')
+
+    def test_is_public_suffix(self):
+        self.assertTrue(is_public_suffix('com'))
+        self.assertTrue(is_public_suffix('.co.uk'))
+        self.assertTrue(is_public_suffix('test.ck'))
+        self.assertFalse(is_public_suffix('test.com'))
+        self.assertFalse(is_public_suffix('www.ck'))
+
+    def test_get_registrable_domain(self):
+        self.assertEqual(get_registrable_domain('a.b.www.test.co.uk'), 'test.co.uk')
+        self.assertEqual(get_registrable_domain('test.com'), 'test.com')
+        self.assertIsNone(get_registrable_domain('co.uk'))
@@ -0,0 +1,241 @@
+from datetime import datetime, timedelta
+
+from dummycache import cache as dummycache_cache
+from dummycache.cache import Cache
+from requests.exceptions import TooManyRedirects
+from requests.models import Response
+
+from dogbutler.models import Request
+from dogbutler.redirect import RedirectManager
+from .dogbutler.tests.base import BaseTestCase
+
+
+class CountingCache(Cache):
+
+    def __init__(self):
+        super(CountingCache, self).__init__()
+        self.gets = 0
+
+    def get(self, key, default=None):
+        self.gets += 1
+        return super(CountingCache, self).get(key, default)
+
+
+class TestRedirect(BaseTestCase):
+
+    def setUp(self):
+        super(TestRedirect, self).setUp()
+        self.cache = CountingCache()
+        self.redirect_manager = RedirectManager(key_prefix='test_redirect', cache=self.cache, max_redirects=5)
+
+    def set_redirects(self, redirects):
+        for url, redirect_to in redirects:
+            self.cache.set(self.redirect_manager.get_cache_key(url), redirect_to)
+
+    def process_redirects(self, redirects, final_url):
+        """
+        redirects is a list of (url, status_code, headers) for the redirects
+        leading to final_url.
+        """
+        history = []
+        for url, status_code, headers in redirects:
+            response = Response()
+            response.url = url
+            response.status_code = status_code
+            response.headers = headers
+            history.append(response)
+        response = Response()
+        response.url = final_url
+        response.status_code = 200
+        response.history = history
+        self.redirect_manager.process_response(Request(redirects[0][0]), response)
+
+    def resolve(self, url):
+        request = Request(url)
+        self.redirect_manager.process_request(request)
+        return request.url
+
+    def test_chain_stored_compressed(self):
+        responses = []
+        for i, status_code in enumerate([301, 301, 302, 301, 301]):
+            response = Response()
+            response.url = 'http://www.test.com/%d' % i
+            response.status_code = status_code
+            responses.append(response)
+        response = Response()
+        response.url = 'http://www.test.com/final'
+        response.status_code = 200
+        response.history = responses
+        self.redirect_manager.process_response(Request('http://www.test.com/0'), response)
+
+        # The 302 breaks the chain, and is never stored
+        self.cache.gets = 0
+        self.assertEqual(self.resolve('http://www.test.com/0'), 'http://www.test.com/2')
+        self.assertEqual(self.cache.gets, 2)
+        self.assertEqual(self.resolve('http://www.test.com/1'), 'http://www.test.com/2')
+        self.assertEqual(self.resolve('http://www.test.com/3'), 'http://www.test.com/final')
+        self.assertEqual(self.resolve('http://www.test.com/4'), 'http://www.test.com/final')
+
+    def test_chain_compressed_on_lookup(self):
+        self.set_redirects([('http://www.test.com/%d' % i, 'http://www.test.com/%d' % (i + 1)) for i in range(4)])
+        self.assertEqual(self.resolve('http://www.test.com/0'), 'http://www.test.com/4')
+
+        self.cache.gets = 0
+        self.assertEqual(self.resolve('http://www.test.com/0'), 'http://www.test.com/4')
+        self.assertEqual(self.cache.gets, 2)
+
+    def test_loop(self):
+        self.set_redirects([('http://www.test.com/a', 'http://www.test.com/b'),
+                            ('http://www.test.com/b', 'http://www.test.com/c'),
+                            ('http://www.test.com/c', 'http://www.test.com/a')])
+        self.assertRaises(TooManyRedirects, self.resolve, 'http://www.test.com/a')
+        self.assertTrue(self.cache.gets <= 3)
+
+        # The loop is forgotten
+        self.assertEqual(self.resolve('http://www.test.com/a'), 'http://www.test.com/a')
+
+    def test_max_redirects(self):
+        self.set_redirects([('http://www.test.com/%d' % i, 'http://www.test.com/%d' % (i + 1)) for i in range(6)])
+        self.assertRaises(TooManyRedirects, self.resolve, 'http://www.test.com/0')
+
+        # The chain is forgotten
+        self.assertEqual(self.resolve('http://www.test.com/1'), 'http://www.test.com/1')
+
+    def test_cacheable_redirects(self):
+        self.process_redirects([('http://www.test.com/301', 301, {})], 'http://www.test.com/final')
+        self.process_redirects([('http://www.test.com/308', 308, {})], 'http://www.test.com/final')
+        self.process_redirects([('http://www.test.com/302', 302, {})], 'http://www.test.com/final')
+        self.process_redirects([('http://www.test.com/302-max-age', 302, {'Cache-Control': 'max-age=10'})],
+                               'http://www.test.com/final')
+        self.process_redirects([('http://www.test.com/307-expires', 307, {
+                                    'Date': 'Mon, 01 Oct 2012 00:00:00 GMT',
+                                    'Expires': 'Mon, 01 Oct 2012 00:00:20 GMT',
+                                })], 'http://www.test.com/final')
+        self.process_redirects([('http://www.test.com/301-no-store', 301, {'Cache-Control': 'no-store'})],
+                               'http://www.test.com/final')
+        self.process_redirects([('http://www.test.com/301-max-age', 301, {'Cache-Control': 'max-age=30'})],
+                               'http://www.test.com/final')
+
+        self.assertEqual(self.resolve('http://www.test.com/301'), 'http://www.test.com/final')
+        self.assertEqual(self.resolve('http://www.test.com/308'), 'http://www.test.com/final')
+        self.assertEqual(self.resolve('http://www.test.com/302'), 'http://www.test.com/302')
+        self.assertEqual(self.resolve('http://www.test.com/302-max-age'), 'http://www.test.com/final')
+        self.assertEqual(self.resolve('http://www.test.com/307-expires'), 'http://www.test.com/final')
+        self.assertEqual(self.resolve('http://www.test.com/301-no-store'), 'http://www.test.com/301-no-store')
+
+        # 10 seconds pass by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=10)
+        self.assertEqual(self.resolve('http://www.test.com/302-max-age'), 'http://www.test.com/302-max-age')
+        self.assertEqual(self.resolve('http://www.test.com/307-expires'), 'http://www.test.com/final')
+
+        # 30 seconds pass by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=30)
+        self.assertEqual(self.resolve('http://www.test.com/307-expires'), 'http://www.test.com/307-expires')
+        self.assertEqual(self.resolve('http://www.test.com/301-max-age'), 'http://www.test.com/301-max-age')
+
+        # A day passes by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(days=1)
+        self.assertEqual(self.resolve('http://www.test.com/301'), 'http://www.test.com/301')
+
+    def test_compressed_chain_expires_with_first_redirect(self):
+        self.process_redirects([('http://www.test.com/0', 301, {}),
+                                ('http://www.test.com/1', 302, {'Cache-Control': 'max-age=10'}),
+                                ('http://www.test.com/2', 308, {})], 'http://www.test.com/final')
+        self.assertEqual(self.resolve('http://www.test.com/0'), 'http://www.test.com/final')
+
+        # 10 seconds pass by, the 302 expires and so does the chain through it
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=10)
+        self.assertEqual(self.resolve('http://www.test.com/0'), 'http://www.test.com/0')
+        self.assertEqual(self.resolve('http://www.test.com/1'), 'http://www.test.com/1')
+        self.assertEqual(self.resolve('http://www.test.com/2'), 'http://www.test.com/final')
+
+    def test_compressed_chain_expires_with_last_redirect(self):
+        now = datetime.now()
+        self.redirect_manager._set('http://www.test.com/a', 'http://www.test.com/b', now + timedelta(days=1))
+        self.redirect_manager._set('http://www.test.com/b', 'http://www.test.com/c', now + timedelta(seconds=60))
+        self.assertEqual(self.resolve('http://www.test.com/a'), 'http://www.test.com/c')
+        redirect_to, expires = self.cache.get(self.redirect_manager.get_cache_key('http://www.test.com/a'))
+        self.assertEqual(redirect_to, 'http://www.test.com/c')
+        self.assertLessEqual(expires, now + timedelta(seconds=60))
+
+        # 60 seconds pass by, the second redirect expires and so does the chain through it
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=60)
+        self.assertEqual(self.resolve('http://www.test.com/a'), 'http://www.test.com/a')
+
+    def test_max_entries(self):
+        redirect_manager = RedirectManager(key_prefix='test_redirect', cache=self.cache, max_entries=2)
+        for i in range(3):
+            response = Response()
+            response.url = 'http://www.test.com/%d' % i
+            response.status_code = 301
+            response.headers = {}
+            final = Response()
+            final.url = 'http://www.test.com/final'
+            final.history = [response]
+            redirect_manager.process_response(Request(response.url), final)
+        self.assertIsNone(self.cache.get(redirect_manager.get_cache_key('http://www.test.com/0')))
+        self.assertIsNotNone(self.cache.get(redirect_manager.get_cache_key('http://www.test.com/1')))
+        self.assertIsNotNone(self.cache.get(redirect_manager.get_cache_key('http://www.test.com/2')))
+
+    def test_host_rewrite(self):
+        for path in ('/a', '/b'):
+            self.process_redirects([('http://www.test.com%s' % path, 301, {})], 'https://www.test.com%s' % path)
+        # Seen twice is not enough
+        self.assertEqual(self.resolve('http://www.test.com/new?q=1'), 'http://www.test.com/new?q=1')
+
+        # The same path twice counts once
+        self.process_redirects([('http://www.test.com/a', 301, {})], 'https://www.test.com/a')
+        self.assertEqual(self.resolve('http://www.test.com/new?q=1'), 'http://www.test.com/new?q=1')
+
+        self.process_redirects([('http://www.test.com/c', 301, {})], 'https://www.test.com/c')
+        request = Request('http://www.test.com/new?q=1')
+        self.redirect_manager.process_request(request)
+        self.assertEqual(request.url, 'https://www.test.com/new?q=1')
+        self.assertEqual(request.rewritten_from, 'http://www.test.com/new?q=1')
+
+        # Other hosts and moved paths are not rewritten
+        self.assertEqual(self.resolve('http://test.com/new'), 'http://test.com/new')
+        self.process_redirects([('http://www.food.com/old', 301, {})], 'https://www.food.com/new')
+        self.process_redirects([('http://www.food.com/a', 301, {})], 'https://www.food.com/a')
+        self.process_redirects([('http://www.food.com/b', 301, {})], 'https://food.com/b')
+        self.process_redirects([('http://www.food.com/c', 301, {})], 'https://food.com/c')
+        self.assertEqual(self.resolve('http://www.food.com/new'), 'http://www.food.com/new')
+
+        # 1 day passes by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(days=1)
+        self.assertEqual(self.resolve('http://www.test.com/new'), 'http://www.test.com/new')
+
+    def test_host_rewrite_fallback(self):
+        for path in ('/a', '/b', '/c'):
+            self.process_redirects([('http://www.test.com%s' % path, 301, {})], 'https://www.test.com%s' % path)
+        request = Request('http://www.test.com/new')
+        self.redirect_manager.process_request(request)
+
+        response = Response()
+        response.url = 'https://www.test.com/new'
+        response.status_code = 200
+        self.assertFalse(self.redirect_manager.fallback(request, response))
+        self.assertFalse(self.redirect_manager.fallback(Request('http://www.test.com/new'), None))
+
+        # An error is what the original URL would have given too
+        response.status_code = 404
+        self.assertFalse(self.redirect_manager.fallback(request, response))
+        self.assertEqual(self.resolve('http://www.test.com/new'), 'https://www.test.com/new')
+
+        # Being sent back to the original origin is not
+        redirect = Response()
+        redirect.url = 'https://www.test.com/new'
+        redirect.status_code = 301
+        response.url = 'http://www.test.com/new'
+        response.status_code = 200
+        response.history = (redirect,)
+        self.assertTrue(self.redirect_manager.fallback(request, response))
+        self.assertEqual(self.resolve('http://www.test.com/new'), 'http://www.test.com/new')
+
+        # And neither is failing to connect
+        for path in ('/a', '/b', '/c'):
+            self.process_redirects([('http://www.test.com%s' % path, 301, {})], 'https://www.test.com%s' % path)
+        request = Request('http://www.test.com/new')
+        self.redirect_manager.process_request(request)
+        self.assertTrue(self.redirect_manager.fallback(request, None))
+        self.assertEqual(self.resolve('http://www.test.com/new'), 'http://www.test.com/new')
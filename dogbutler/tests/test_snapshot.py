@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+
+from dummycache.cache import Cache
+from requests.models import Response
+
+from dogbutler.cookie import CookieManager
+from dogbutler.snapshot import CookieSnapshot
+from .dogbutler.tests.base import BaseTestCase
+
+
+class TestCookieSnapshot(BaseTestCase):
+
+    def setUp(self):
+        super(TestCookieSnapshot, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cookies.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestCookieSnapshot, self).tearDown()
+
+    def set_cookie(self, cookie_manager, url, set_cookie_header):
+        response = Response()
+        response.headers = {'Set-Cookie': set_cookie_header}
+        response.url = url
+        cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+
+    def test_save_and_load(self):
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=Cache(), snapshot=CookieSnapshot(self.path))
+        self.set_cookie(cookie_manager, 'http://www.test.com/path',
+                        'chipsahoy=cookie; Domain=test.com; Max-Age=60;, coke=soda;')
+        self.set_cookie(cookie_manager, 'http://www.food.com/path',
+                        'kfc=chicken; Domain=food.com;, flash=message; Domain=food.com; Max-Age=60;')
+        self.set_cookie(cookie_manager, 'http://www.food.com/path', 'flash=; Domain=food.com; Max-Age=0;')
+        self.assertEqual(cookie_manager.get_cookies('http://www.food.com/'), {'kfc': 'chicken'})
+        cookie_manager.close()
+        cookie_manager.snapshot.close()
+
+        # A new process starts with the same cookies
+        cache = Cache()
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=cache, snapshot=CookieSnapshot(self.path))
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/'), {'chipsahoy': 'cookie', 'coke': 'soda'})
+
+        # Each domain is only loaded when first used
+        kfc_key = cookie_manager.get_domain_cookie_key('food.com', '', 'kfc')
+        self.assertIsNone(cache.get(kfc_key))
+        self.assertEqual(cookie_manager.get_cookies('http://www.food.com/'), {'kfc': 'chicken'})
+        self.assertIsNotNone(cache.get(kfc_key))
+        cookie_manager.snapshot.close()
+
+    def test_set_cookie_before_load(self):
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=Cache(), snapshot=CookieSnapshot(self.path))
+        self.set_cookie(cookie_manager, 'http://www.test.com/path',
+                        'chipsahoy=cookie; Domain=test.com;, cadbury=chocolate; Domain=test.com;')
+        cookie_manager.save()
+        cookie_manager.snapshot.close()
+
+        # Cookies set in the new process win over the ones in the snapshot
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=Cache(), snapshot=CookieSnapshot(self.path))
+        self.set_cookie(cookie_manager, 'http://www.test.com/path', 'chipsahoy=crumbs; Domain=test.com;')
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/'), {'chipsahoy': 'crumbs', 'cadbury': 'chocolate'})
+        cookie_manager.snapshot.close()
+
+    def test_evicted_cookies_not_saved(self):
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=Cache(), snapshot=CookieSnapshot(self.path),
+                                       max_cookies_per_domain=1)
+        self.set_cookie(cookie_manager, 'http://www.test.com/path', 'chipsahoy=cookie; Domain=test.com;')
+        cookie_manager.save()
+        self.set_cookie(cookie_manager, 'http://www.test.com/path', 'cadbury=chocolate; Domain=test.com;')
+        cookie_manager.save()
+        cookie_manager.snapshot.close()
+
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=Cache(), snapshot=CookieSnapshot(self.path))
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/'), {'cadbury': 'chocolate'})
+        cookie_manager.snapshot.close()
+
+    def test_loaded_lookup_sets_bounded(self):
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=Cache(), snapshot=CookieSnapshot(self.path))
+        self.set_cookie(cookie_manager, 'http://www.test.com/path',
+                        'chipsahoy=cookie; Domain=test.com;, cadbury=chocolate; Domain=test.com;')
+        self.set_cookie(cookie_manager, 'http://www.food.com/path', 'kfc=chicken; Domain=food.com;')
+        cookie_manager.save()
+        cookie_manager.snapshot.close()
+
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=Cache(), snapshot=CookieSnapshot(self.path),
+                                       index_max_entries=1)
+        self.set_cookie(cookie_manager, 'http://www.test.com/path',
+                        'chipsahoy=crumbs; Domain=test.com;, cadbury=; Domain=test.com; Max-Age=0;')
+        self.set_cookie(cookie_manager, 'http://www.food.com/path', 'kfc=nuggets; Domain=food.com;')
+        self.assertEqual(len(cookie_manager._snapshot_loaded), 1)
+
+        # Loading test.com again does not bring back what was changed since
+        self.set_cookie(cookie_manager, 'http://www.test.com/path', 'oreo=cookie; Domain=test.com;')
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/'), {'chipsahoy': 'crumbs', 'oreo': 'cookie'})
+        self.assertEqual(cookie_manager.get_cookies('http://www.food.com/'), {'kfc': 'nuggets'})
+        cookie_manager.snapshot.close()
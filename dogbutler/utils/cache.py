@@ -18,12 +18,115 @@ An example: i18n middleware would need to distinguish caches by the
 """
 
 import re
+import time
 
 from .dogbutler.utils.encoding import iri_to_uri
 from .dogbutler.utils.hashcompat import md5_constructor
+from dogbutler.utils.http import parse_http_date_safe, _memoize
 
 cc_delim_re = re.compile(r'\s*,\s*')
 
+HEURISTIC_FRESHNESS_FRACTION = 0.1          # Of the time since Last-Modified, as suggested by RFC 7234 4.2.2
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60      # Longest heuristic freshness lifetime, in seconds
+HEURISTICALLY_CACHEABLE_STATUS_CODES = (200, 203, 204, 206, 300, 301, 404, 405, 410, 414, 501)
+
+
+class CacheControl(object):
+    """
+    The directives of a Cache-Control header, parsed once. Get one with
+    parse_cache_control(), which shares them between identical headers, and
+    do not modify it.
+    """
+
+    def __init__(self, value):
+        self.directives = dict([_to_tuple(el) for el in cc_delim_re.split(value.strip()) if el]) if value else {}
+
+    def __contains__(self, directive):
+        return directive in self.directives
+
+    def get_seconds(self, directive):
+        """
+        Returns the delta-seconds value of directive as an integer (or ``None``
+        if it wasn't found or wasn't an integer).
+        """
+        value = self.directives.get(directive)
+        if value is None or value is True:
+            return
+        try:
+            return int(value.strip('"'))
+        except ValueError:
+            pass
+
+    @property
+    def max_age(self):
+        return self.get_seconds('max-age')
+
+    @property
+    def s_maxage(self):
+        return self.get_seconds('s-maxage')
+
+    @property
+    def no_store(self):
+        return 'no-store' in self
+
+    @property
+    def no_cache(self):
+        # Also true for the qualified form, no-cache="field"
+        return 'no-cache' in self
+
+    @property
+    def must_revalidate(self):
+        return 'must-revalidate' in self or 'proxy-revalidate' in self
+
+    @property
+    def private(self):
+        return 'private' in self
+
+
+@_memoize
+def parse_cache_control(value):
+    """
+    Returns the CacheControl for a Cache-Control header value, which may be
+    ``None`` if there is no header.
+    """
+    return CacheControl(value)
+
+
+def get_many(cache, keys):
+    """
+    Returns a dictionary of the values found in cache for keys, in a single
+    round trip if the cache supports get_many.
+    """
+    if hasattr(cache, 'get_many'):
+        return cache.get_many(keys)
+    values = {}
+    for key in keys:
+        value = cache.get(key)
+        if value is not None:
+            values[key] = value
+    return values
+
+def set_many(cache, values):
+    """
+    Sets the given dictionary of values in cache, in a single round trip if
+    the cache supports set_many.
+    """
+    if hasattr(cache, 'set_many'):
+        cache.set_many(values)
+    else:
+        for key, value in values.items():
+            cache.set(key, value)
+
+def delete_many(cache, keys):
+    """
+    Deletes keys from cache, in a single round trip if the cache supports
+    delete_many.
+    """
+    if hasattr(cache, 'delete_many'):
+        cache.delete_many(keys)
+    else:
+        for key in keys:
+            cache.delete(key)
 
 def get_max_age(response):
     """
@@ -32,13 +135,80 @@ def get_max_age(response):
     """
     if not response.has_header('Cache-Control'):
         return
-    cc = dict([_to_tuple(el) for el in
-               cc_delim_re.split(response['Cache-Control'])])
-    if 'max-age' in cc:
+    return parse_cache_control(response['Cache-Control']).max_age
+
+def get_expires_max_age(response):
+    """
+    Returns the freshness lifetime given by the response Expires header,
+    counted from its Date header (or from now if there is none), as an integer
+    (or ``None`` if there is no Expires header). An Expires header that is not
+    a valid date means the response is already stale.
+    """
+    if not response.has_header('Expires'):
+        return
+    expires = parse_http_date_safe(response['Expires'])
+    if expires is None:
+        return 0
+    return max(0, int(expires - _get_date(response)))
+
+def get_heuristic_max_age(response):
+    """
+    Returns a heuristic freshness lifetime for a response with no explicit
+    one, a fraction of the time since its Last-Modified header, as an integer
+    (or ``None`` if it has no valid Last-Modified header or its status code
+    does not allow heuristic freshness).
+    """
+    if response.status_code not in HEURISTICALLY_CACHEABLE_STATUS_CODES or not response.has_header('Last-Modified'):
+        return
+    last_modified = parse_http_date_safe(response['Last-Modified'])
+    if last_modified is None:
+        return
+    age = max(0, _get_date(response) - last_modified)
+    return min(MAX_HEURISTIC_FRESHNESS, int(age * HEURISTIC_FRESHNESS_FRACTION))
+
+def get_freshness_lifetime(response, shared=False):
+    """
+    Returns the freshness lifetime of a response as an integer, following
+    RFC 7234 section 4.2.1: s-maxage (in a shared cache only), then max-age,
+    then Expires, then a heuristic from Last-Modified (or ``None`` if none of
+    them apply).
+    """
+    cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+    lifetime = cache_control.s_maxage if shared else None
+    if lifetime is None:
+        lifetime = cache_control.max_age
+    if lifetime is None:
+        lifetime = get_expires_max_age(response)
+    if lifetime is None:
+        lifetime = get_heuristic_max_age(response)
+    return max(0, lifetime) if lifetime is not None else None
+
+def get_current_age(response):
+    """
+    Returns how old a response already was when it was received, following
+    RFC 7234 section 4.2.3: the larger of its Age header and the time since
+    its Date header, as an integer.
+    """
+    age = 0
+    if response.has_header('Age'):
         try:
-            return int(cc['max-age'])
-        except (ValueError, TypeError):
+            age = max(0, int(response['Age']))
+        except ValueError:
             pass
+    date = parse_http_date_safe(response['Date']) if response.has_header('Date') else None
+    if date is not None:
+        age = max(age, int(time.time() - date))
+    return age
+
+def _get_date(response):
+    """
+    Returns the Date header of a response as a timestamp, or now if it has no
+    valid one.
+    """
+    date = parse_http_date_safe(response['Date']) if response.has_header('Date') else None
+    if date is None:
+        date = time.time()
+    return date
 
 #def _i18n_cache_key_suffix(request, cache_key):
 #    """If enabled, returns the cache key ending with a locale."""
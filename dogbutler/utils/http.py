@@ -0,0 +1,148 @@
+"""
+Parsing and formatting of the dates used in HTTP headers and cookies.
+
+The same few date strings (a site's cookie expiry, a CDN's Expires header)
+turn up over and over again, so parsed results are memoized.
+"""
+
+import calendar
+from functools import wraps
+import re
+import time
+
+MEMO_SIZE = 1024        # Number of parsed dates to remember per function
+
+MONTHS = 'jan feb mar apr may jun jul aug sep oct nov dec'.split()
+__D = r'(?P<day>\d{2})'
+__D2 = r'(?P<day>[ \d]\d)'
+__M = r'(?P<mon>\w{3})'
+__Y = r'(?P<year>\d{4})'
+__Y2 = r'(?P<year>\d{2})'
+__T = r'(?P<hour>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2})'
+RFC1123_DATE = re.compile(r'^\w{3}, %s %s %s %s GMT$' % (__D, __M, __Y, __T))
+RFC850_DATE = re.compile(r'^\w{6,9}, %s-%s-%s %s GMT$' % (__D, __M, __Y2, __T))
+ASCTIME_DATE = re.compile(r'^\w{3} %s %s %s %s$' % (__M, __D2, __T, __Y))
+
+
+def _memoize(fn):
+    """
+    Remember the results of fn, a function of one hashable argument. The memo
+    is simply emptied when it reaches MEMO_SIZE entries.
+    """
+    memo = {}
+
+    @wraps(fn)
+    def wrapper(value):
+        try:
+            return memo[value]
+        except KeyError:
+            pass
+        result = fn(value)
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        memo[value] = result
+        return result
+
+    return wrapper
+
+def parse_http_date(date):
+    """
+    Parses a date format as specified by HTTP RFC2616 section 3.3.1.
+
+    The three formats allowed by the RFC are accepted, even if only the first
+    one is still in widespread use.
+
+    Returns an integer expressed in seconds since the epoch, in UTC.
+    """
+    for regex in RFC1123_DATE, RFC850_DATE, ASCTIME_DATE:
+        m = regex.match(date)
+        if m is not None:
+            break
+    else:
+        raise ValueError("%r is not in a valid HTTP date format" % date)
+    try:
+        year = int(m.group('year'))
+        if year < 100:
+            if year < 70:
+                year += 2000
+            else:
+                year += 1900
+        month = MONTHS.index(m.group('mon').lower()) + 1
+        day = int(m.group('day'))
+        hour = int(m.group('hour'))
+        min = int(m.group('min'))
+        sec = int(m.group('sec'))
+        return calendar.timegm((year, month, day, hour, min, sec))
+    except Exception:
+        raise ValueError("%r is not a valid date" % date)
+
+@_memoize
+def parse_http_date_safe(date):
+    """
+    Same as parse_http_date, but returns None if the input is invalid.
+    """
+    try:
+        return parse_http_date(date)
+    except Exception:
+        pass
+
+
+# Cookie date tokens, from the parsing algorithm in RFC 6265 section 5.1.1
+_cookie_date_delimiter_re = re.compile(r'[\x09\x20-\x2f\x3b-\x40\x5b-\x60\x7b-\x7e]+')
+_cookie_date_time_re = re.compile(r'^(\d{1,2}):(\d{1,2}):(\d{1,2})(?:\D|$)')
+_cookie_date_day_re = re.compile(r'^(\d{1,2})(?:\D|$)')
+_cookie_date_year_re = re.compile(r'^(\d{2,4})(?:\D|$)')
+
+_MONTH_NUMBERS = dict((month, i + 1) for i, month in enumerate(MONTHS))
+_WEEKDAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+@_memoize
+def parse_cookie_date(value):
+    """
+    Return the timestamp of a cookie date, or None if it cannot be parsed.
+    Follows the lenient algorithm of RFC 6265 section 5.1.1, so dashed,
+    spaced, RFC 850 and asctime dates are all accepted.
+    """
+    hms = day = month = year = None
+    for token in _cookie_date_delimiter_re.split(value):
+        if not token:
+            continue
+        if hms is None:
+            match = _cookie_date_time_re.match(token)
+            if match:
+                hms = [int(n) for n in match.groups()]
+                continue
+        if day is None:
+            match = _cookie_date_day_re.match(token)
+            if match:
+                day = int(match.group(1))
+                continue
+        if month is None:
+            month = _MONTH_NUMBERS.get(token[:3].lower())
+            if month is not None:
+                continue
+        if year is None:
+            match = _cookie_date_year_re.match(token)
+            if match:
+                year = int(match.group(1))
+                continue
+
+    if hms is None or day is None or month is None or year is None:
+        return None
+    if 70 <= year <= 99:
+        year += 1900
+    elif 0 <= year <= 69:
+        year += 2000
+    if not 1 <= day <= 31 or year < 1601 or hms[0] > 23 or hms[1] > 59 or hms[2] > 59:
+        return None
+    return calendar.timegm((year, month, day, hms[0], hms[1], hms[2]))
+
+def format_cookie_date(timestamp):
+    """
+    Return timestamp in the dashed cookie date format, e.g. 'Thu, 12-Jan-2013 12:34:22 GMT'
+    """
+    t = time.gmtime(timestamp)
+    return '%s, %02d-%s-%04d %02d:%02d:%02d GMT' % (
+        _WEEKDAY_NAMES[t.tm_wday], t.tm_mday, _MONTH_NAMES[t.tm_mon - 1], t.tm_year, t.tm_hour, t.tm_min, t.tm_sec)
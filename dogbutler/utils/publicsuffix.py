@@ -0,0 +1,97 @@
+"""
+Public suffixes (such as 'com' or 'co.uk') from the Public Suffix List,
+https://publicsuffix.org/list/, bundled as public_suffix_list.dat.
+
+Cookies must not be set on a public suffix, and no cookie can apply to a
+domain above the registrable domain, the public suffix plus one label. The
+list is compiled into sets of rules the first time it is needed.
+"""
+import os
+from threading import Lock
+
+
+PUBLIC_SUFFIX_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public_suffix_list.dat')
+
+_rules = None
+_rules_lock = Lock()
+
+
+def _to_ascii(rule):
+    """
+    Return rule with its internationalized labels in punycode, as they
+    appear in URLs, or None if a label cannot be encoded.
+    """
+    try:
+        rule.encode('ascii')
+        return rule
+    except UnicodeError:
+        pass
+    try:
+        return '.'.join(label if label == '*' else label.encode('idna')
+                        for label in rule.decode('utf-8').split('.'))
+    except UnicodeError:
+        return None
+
+def load_rules(path=PUBLIC_SUFFIX_LIST):
+    """
+    Return a tuple of (rules, wildcards, exceptions) read from the list at
+    path: the plain rules, the domains under which any label is a public
+    suffix ('*.ck' gives 'ck'), and the exceptions to those ('!www.ck').
+    """
+    rules, wildcards, exceptions = set(), set(), set()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('//'):
+                continue
+            rule = _to_ascii(line.split()[0].lower())
+            if rule is None:
+                continue
+            if rule.startswith('!'):
+                exceptions.add(rule[1:])
+            elif rule.startswith('*.'):
+                wildcards.add(rule[2:])
+            else:
+                rules.add(rule)
+    return frozenset(rules), frozenset(wildcards), frozenset(exceptions)
+
+def get_rules():
+    global _rules
+    if _rules is None:
+        with _rules_lock:
+            if _rules is None:
+                _rules = load_rules()
+    return _rules
+
+def get_public_suffix(domain):
+    """
+    Return the public suffix of domain. A domain no rule matches is taken to
+    be under a public suffix of its last label, as the list asks.
+    """
+    rules, wildcards, exceptions = get_rules()
+    labels = domain.lower().strip('.').split('.')
+
+    # Longest suffix first, so that the longest matching rule wins
+    for i in range(len(labels)):
+        suffix = '.'.join(labels[i:])
+        if suffix in exceptions:
+            return '.'.join(labels[i+1:])
+        if suffix in rules:
+            return suffix
+        if i + 1 < len(labels) and '.'.join(labels[i+1:]) in wildcards:
+            return suffix
+    return labels[-1]
+
+def is_public_suffix(domain):
+    return get_public_suffix(domain) == domain.lower().strip('.')
+
+def get_registrable_domain(domain):
+    """
+    Return the public suffix of domain plus one label, or None if domain is
+    itself a public suffix.
+    """
+    labels = domain.lower().strip('.').split('.')
+    suffix_length = get_public_suffix(domain).count('.') + 1
+    if len(labels) <= suffix_length:
+        return None
+    return '.'.join(labels[-suffix_length-1:])
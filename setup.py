@@ -20,6 +20,7 @@ setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
         "License :: OSI Approved :: GNU General Public License (GPL)"
     ],
-    packages = ['dogbutler'],
+    packages = ['dogbutler', 'dogbutler.utils'],
+    package_data = {'dogbutler.utils': ['public_suffix_list.dat']},
     install_requires = ['dummycache', 'requests'],
 )